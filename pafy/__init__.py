@@ -3,12 +3,35 @@ __author__ = "np1"
 __license__ = "LGPLv3"
 
 
+import sys
+
 # External api
 from .pafy import new
 from .pafy import set_api_key
 from .pafy import load_cache, dump_cache
 from .pafy import get_categoryname
 from .pafy import backend
-from .util import GdataError, call_gdata
-from .playlist import get_playlist, get_playlist2
-from .channel import get_channel
+from .util import GdataError, call_gdata, gdata_governor, throughput_stats
+from .util import set_json_backend
+from .thumbs import get_bestthumbs, fetch_thumbs
+from .instrument import add_hook, remove_hook, PhaseStats
+
+# The playlist and channel modules are imported on first use where possible
+_lazy = {'get_playlist': 'playlist', 'get_playlist2': 'playlist',
+         'get_channel': 'channel'}
+
+if sys.version_info[:2] >= (3, 7):
+    from importlib import import_module
+
+    def __getattr__(name):
+        """ Import lazily exported functions on first access. """
+        if name not in _lazy:
+            raise AttributeError("module %r has no attribute %r" %
+                                 (__name__, name))
+        module = import_module("." + _lazy[name], __name__)
+        globals()[name] = getattr(module, name)
+        return globals()[name]
+
+else:
+    from .playlist import get_playlist, get_playlist2
+    from .channel import get_channel
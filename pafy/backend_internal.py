@@ -1,11 +1,11 @@
 import os
 import hashlib
 import tempfile
-import json
 import re
 import sys
 import time
 import logging
+import threading
 from xml.etree import ElementTree
 
 if sys.version_info[:2] >= (3, 0):
@@ -20,10 +20,11 @@ else:
 
 early_py_version = sys.version_info[:2] < (2, 7)
 
-from . import g
+from . import g, util
 from .pafy import fetch_decode, dbg, get_categoryname
-from .backend_shared import BasePafy, BaseStream
+from .backend_shared import BasePafy, BaseStream, timed_fetch
 from .jsinterp import JSInterpreter
+from .instrument import measure, timed
 
 
 funcmap = {}
@@ -42,11 +43,19 @@ class InternPafy(BasePafy):
         super(InternPafy, self).__init__(*args, **kwargs)
 
 
+    @timed_fetch
     def _fetch_basic(self):
         """ Fetch basic data and streams. """
         if self._have_basic:
             return
 
+        # The watch page, needed for the age gate check and, for ciphered
+        # videos, the player javascript url, does not depend on the video
+        # info, fetch both at once
+        watch_url = g.urls['watchv'] % self.videoid
+        if self.callback:
+            self.callback("Fetching watch page")
+        watchpage = util.Background(fetch_watchpage, watch_url)
         allinfo = get_video_info(self.videoid, self.callback)
 
         if self.callback:
@@ -79,10 +88,13 @@ class InternPafy(BasePafy):
             dbg("ciphertag mismatch")
             self.ciphertag = not self.ciphertag
 
-        watch_url = g.urls['watchv'] % self.videoid
-        if self.callback:
-            self.callback("Fetching watch page")
-        watchinfo = fetch_decode(watch_url)  # unicode
+        dash = None
+
+        if not self.ciphertag and self._dashurl != 'unknown':
+            # Only ciphered dash urls need the watch page, to be signed
+            dash = util.Background(_extract_dash, self._dashurl)
+
+        watchinfo = watchpage.result()  # unicode
         dbg("Fetched watch page")
         if self.callback:
             self.callback("Fetched watch page")
@@ -98,7 +110,10 @@ class InternPafy(BasePafy):
                 self.js_url = js_url
                 dashsig = re.search(r"/s/([\w\.]+)", self._dashurl).group(1)
                 dbg("decrypting dash sig")
-                goodsig = _decodesig(dashsig, js_url, self.callback)
+
+                with timed("decipher"):
+                    goodsig = _decodesig(dashsig, js_url, self.callback)
+
                 self._dashurl = re.sub(r"/s/[\w\.]+",
                                        "/signature/%s" % goodsig, self._dashurl)
 
@@ -108,10 +123,17 @@ class InternPafy(BasePafy):
                 self._dashurl = re.sub(r"/s/[\w\.]+",
                                        "/signature/%s" % s, self._dashurl)
 
-        if self._dashurl != 'unknown':
+        if dash:
+            self.dash = dash.result()
+
+        elif self._dashurl != 'unknown':
             self.dash = _extract_dash(self._dashurl)
+
         self._have_basic = 1
-        self._process_streams()
+
+        with timed("streams"):
+            self._process_streams()
+
         self.expiry = time.time() + g.lifespan
 
 
@@ -162,6 +184,7 @@ class InternPafy(BasePafy):
         self._videostreams = videostreams
         self._m4astreams, self._oggstreams = m4astreams, oggstreams
         self._allstreams = streams + videostreams + audiostreams
+        self._build_index()
 
 
 class InternStream(BaseStream):
@@ -194,6 +217,11 @@ class InternStream(BaseStream):
                 self._quality = self._bitrate
 
             self._fsize = int(sm['size'] or 0)
+
+            if sm.get('init') and sm.get('index'):
+                self._index_ranges = tuple(
+                    tuple(int(x) for x in sm[k].split("-"))
+                    for k in ('init', 'index'))
             # self._bitrate = sm['bitrate']
             # self._rawbitrate = uni(int(self._bitrate) // 1024) + "k"
 
@@ -210,6 +238,8 @@ class InternStream(BaseStream):
         self._parent = parent
         self._filename = self.generate_filename()
         self._notes = g.itags[self.itag][3]
+        codec = self._notes.split()[0] if self._notes else ''
+        self._codec = codec if codec in ('AVC', 'VP8', 'VP9', 'Opus') else ''
         self._rawurl = sm['url']
         self._sig = sm['s'] if self.encrypted else sm.get("sig")
         self._active = False
@@ -262,17 +292,118 @@ def parseqs(data):
     return data
 
 
+class WatchPageStats(object):
+
+    """ Counters of watch page fetches, to measure the bytes saved by
+    reading them only up to the player config or age gate. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._counts = dict(partial=0, complete=0, bytes_read=0,
+                                bytes_saved=0)
+
+    def record(self, nbytes=0, complete=False, saved=0):
+        """ Record a fetched watch page. """
+        with self._lock:
+            self._counts["complete" if complete else "partial"] += 1
+            self._counts['bytes_read'] += nbytes
+            self._counts['bytes_saved'] += saved
+
+    def stats(self):
+        """ Return a dict of counters for monitoring. """
+        with self._lock:
+            return dict(self._counts)
+
+
+watchpage_stats = WatchPageStats()
+
+
+class _WatchPageEnd(object):
+
+    """ read_response() stop condition, True once the watch page has been
+    read up to the age gate or the end of the player config.
+
+    Only the newly read data is searched for the start of the player config
+    and the "};" that ends it, g.jsplayer is matched once both are found.
+
+    """
+
+    AGE_GATE = b'player-age-gate-content">'
+    OVERLAP = 64  # longer than the markers searched for
+
+    def __init__(self):
+        self.player = re.compile(g.jsplayer.encode("ascii"))
+        self.config = None  # offset of the player config
+
+    def __call__(self, data, start):
+        tail = max(start - self.OVERLAP, 0)
+
+        if data.find(self.AGE_GATE, tail) != -1:
+            return True
+
+        if self.config is None:
+            config = data.find(b"ytplayer.config", tail)
+
+            if config == -1:
+                return False
+
+            self.config = max(config - 1, 0)
+
+        if data.find(b"};", max(self.config, start - 1)) == -1:
+            return False
+
+        return self.player.search(data, self.config) is not None
+
+
+def fetch_watchpage(url):
+    """ Return the watch page at url, read up to the player config.
+
+    The rest of the page is not needed.  The age gate marker precedes the
+    player config in the page, reading also stops there.  A page without
+    either is read to the end.  Returns unicode.
+
+    """
+    wire, eof = [0], [False]
+
+    with measure("watchpage", url) as event:
+        response = util.open_url(url, compressed=True)
+        event.status = response.getcode()
+        length = response.headers.get('Content-Length')
+        read = response.read
+
+        def counting_read(*args):
+            """ Count bytes received, note the end of the page. """
+            chunk = read(*args)
+            wire[0] += len(chunk)
+            eof[0] = eof[0] or not chunk
+            return chunk
+
+        response.read = counting_read
+        data = util.read_response(response, until=_WatchPageEnd())
+        event.bytes = len(data)
+
+    saved = int(length) - wire[0] if length else 0
+    dbg("Read %d bytes of watch page, %d bytes saved", wire[0], saved)
+    watchpage_stats.record(nbytes=wire[0], complete=eof[0], saved=saved)
+    # a partial page may end inside a multibyte character
+    return data.decode("utf8", "ignore")
+
+
 def get_video_info(video_id, callback, newurl=None):
     """ Return info for video_id.  Returns dict. """
     # TODO: see if there is a way to avoid retrieving the embed page
     #       just for this, or to use it for more. This was coppied from
     #       youtube-dl.
-    embed_webpage = fetch_decode(g.urls['embed'])
+    embed_webpage = fetch_decode(g.urls['embed'], phase="embed")
     sts = re.search(r'sts"\s*:\s*(\d+)', embed_webpage).group(1)
 
     url = g.urls['vidinfo'] % (video_id, video_id, sts)
     url = newurl if newurl else url
-    info = fetch_decode(url)  # bytes
+    info = fetch_decode(url, phase="vidinfo")  # bytes
     info = parseqs(info)  # unicode dict
     dbg("Fetched video info%s", " (age ver)" if newurl else "")
 
@@ -299,7 +430,7 @@ def _extract_dash(dashurl):
     """ Download dash url and extract some data. """
     # pylint: disable = R0914
     dbg("Fetching dash page")
-    dashdata = fetch_decode(dashurl)
+    dashdata = fetch_decode(dashurl, phase="dash")
     dbg("DASH list fetched")
     ns = "{urn:mpeg:DASH:schema:MPD:2011}"
     ytns = "{http://youtube.com/yt/2012/10/10}"
@@ -315,13 +446,23 @@ def _extract_dash(dashurl):
         itag = uni(x.get("id"))
         width = uni(x.get("width"))
         height = uni(x.get("height"))
+        segbase = x.find("%sSegmentBase" % ns)
+        init = index = None
+
+        if segbase is not None and segbase.find("%sInitialization" % ns) \
+                is not None:
+            index = segbase.get("indexRange")
+            init = segbase.find("%sInitialization" % ns).get("range")
+
         dashmap.append(dict(bitrate=bitrate,
                             dash=True,
                             itag=itag,
                             width=width,
                             height=height,
                             url=url,
-                            size=size))
+                            size=size,
+                            init=init,
+                            index=index))
     return dashmap
 
 
@@ -350,7 +491,8 @@ def _decodesig(sig, js_url, callback):
     return solved
 
 
-def fetch_cached(url, callback, encoding=None, dbg_ref="", file_prefix=""):
+def fetch_cached(url, callback, encoding=None, dbg_ref="", file_prefix="",
+                 phase="fetch"):
     """ Fetch url - from tmpdir if already retrieved. """
     tmpdir = os.path.join(tempfile.gettempdir(), "pafy")
 
@@ -363,13 +505,18 @@ def fetch_cached(url, callback, encoding=None, dbg_ref="", file_prefix=""):
     if os.path.exists(cached_filename):
         dbg("fetched %s from cache", dbg_ref)
 
-        with open(cached_filename) as f:
-            retval = f.read()
+        with measure(phase, url) as event:
+            event.cache_hit = True
+
+            with open(cached_filename) as f:
+                retval = f.read()
+
+            event.bytes = len(retval)
 
         return retval
 
     else:
-        data = fetch_decode(url, "utf8")  # unicode
+        data = fetch_decode(url, "utf8", phase)  # unicode
         dbg("Fetched %s", dbg_ref)
         if callback:
             callback("Fetched %s" % dbg_ref)
@@ -421,7 +568,7 @@ def get_js_sm(watchinfo, callback):
 
     """
     m = re.search(g.jsplayer, watchinfo)
-    myjson = json.loads(m.group(1))
+    myjson = util.json_loads(m.group(1))
     stream_info = myjson['args']
     sm = _extract_smap(g.UEFSM, stream_info, False)
     asm = _extract_smap(g.AF, stream_info, False)
@@ -434,8 +581,11 @@ def get_js_sm(watchinfo, callback):
         if callback:
             callback("Fetching javascript")
         javascript = fetch_cached(js_url, callback, encoding="utf8",
-                                  dbg_ref="javascript", file_prefix="js-")
-        mainfunc = _get_mainfunc_from_js(javascript)
+                                  dbg_ref="javascript", file_prefix="js-",
+                                  phase="js")
+
+        with timed("jsparse"):
+            mainfunc = _get_mainfunc_from_js(javascript)
 
     elif mainfunc:
         dbg("Using functions in memory extracted from %s", js_url)
@@ -1,19 +1,29 @@
+import io
 import os
 import re
 import sys
 import time
+import shutil
 import logging
+import tempfile
+import threading
 import subprocess
+from functools import wraps
+
+try:
+    from collections import OrderedDict
+
+except ImportError:  # Python 2.6, Pafy.timings is then not ordered
+    OrderedDict = dict
 
 if sys.version_info[:2] >= (3, 0):
     # pylint: disable=E0611,F0401,I0011
-    from urllib.request import urlopen, build_opener
     from urllib.error import HTTPError, URLError
     from urllib.parse import parse_qs, urlparse
     uni, pyver = str, 3
 
 else:
-    from urllib2 import urlopen, build_opener, HTTPError, URLError
+    from urllib2 import HTTPError, URLError
     from urlparse import parse_qs, urlparse
     uni, pyver = unicode, 2
 
@@ -22,7 +32,12 @@ early_py_version = sys.version_info[:2] < (2, 7)
 from . import __version__, g
 from .pafy import call_gdata
 from .playlist import get_playlist2
-from .util import xenc
+from .util import xenc, open_url, build_request, retry_policy, WriteBehind
+from .util import Hashes, ThroughputMonitor, throughput_stats
+from .selector import StreamIndex, get_selector
+from .thumbs import get_bestthumb
+from .instrument import Event, emit, collect, measure
+from . import dash
 
 dbg = logging.debug
 
@@ -51,12 +66,26 @@ def extract_video_id(url):
     raise ValueError(err % url)
 
 
+def timed_fetch(fetch_basic):
+    """ Decorate a _fetch_basic method to collect the time spent in each
+    phase into self.timings. """
+    @wraps(fetch_basic)
+    def wrapper(self):
+        if self._have_basic:
+            return
+
+        with collect(self.timings):
+            fetch_basic(self)
+
+    return wrapper
+
+
 class BasePafy(object):
 
     """ Class to represent a YouTube video. """
 
     def __init__(self, video_url, basic=True, gdata=False,
-                 size=False, callback=None, ydl_opts=None):
+                 size=False, callback=None, ydl_opts=None, flat=False):
         """ Set initial values. """
         self.version = __version__
         self.videoid = extract_video_id(video_url)
@@ -91,7 +120,10 @@ class BasePafy(object):
         self._bigthumbhd = None
         self._bestthumb = None
         self._mix_pl = None
+        self._index = None
+        self._flat = flat
         self.expiry = None
+        self.timings = OrderedDict()
 
         if basic:
             self._fetch_basic()
@@ -133,6 +165,44 @@ class BasePafy(object):
         """ Create Stream object lists from internal stream maps. """
         raise NotImplementedError
 
+    @property
+    def expired(self):
+        """ True if the stream urls have expired. """
+        return self.expiry is not None and time.time() > self.expiry
+
+    def refresh(self):
+        """ Fetch the video again for fresh stream urls.
+
+        Stream objects already created are kept and updated with the new
+        urls of the same itag.
+
+        """
+        dbg("Refreshing stream urls of %s", self.videoid)
+        old = dict((s.itag, s) for s in self._allstreams)
+        self._have_basic = False
+        self._flat = False
+        self._fetch_basic()
+        self._process_streams()
+
+        if not old:
+            return
+
+        def keep(stream):
+            """ Return the existing stream of the same itag, updated. """
+            if stream.itag not in old:
+                return stream
+
+            old[stream.itag]._adopt(stream)
+            return old[stream.itag]
+
+        self._streams = [keep(s) for s in self._streams]
+        self._videostreams = [keep(s) for s in self._videostreams]
+        self._audiostreams = [keep(s) for s in self._audiostreams]
+        self._m4astreams = [keep(s) for s in self._m4astreams]
+        self._oggstreams = [keep(s) for s in self._oggstreams]
+        self._allstreams = [keep(s) for s in self._allstreams]
+        self._build_index()
+
 
     def __repr__(self):
         """ Print video metadata. Return utf8 string. """
@@ -335,13 +405,30 @@ class BasePafy(object):
                 return None
         return self._mix_pl
 
-    def _sortvideokey(self, x, key3d=0, keyres=0, keyftype=0, preftype="any", ftypestrict=True):
-        """ Sort function. """
-        key3d = "3D" not in x.resolution
-        keyres = int(x.resolution.split("x")[0])
-        keyftype = preftype == x.extension
-        strict, nonstrict = (key3d, keyftype, keyres), (key3d, keyres, keyftype)
-        return strict if ftypestrict else nonstrict
+    @property
+    def _stream_index(self):
+        """ Return the selection index, processing streams if needed. """
+        if self._index is None:
+            self._process_streams()
+
+        return self._index
+
+    def _build_index(self):
+        """ Build the selection index, called by _process_streams. """
+        self._index = StreamIndex(self._streams, self._videostreams,
+                                  self._audiostreams)
+
+    def select(self, selector):
+        """ Return the stream(s) chosen by a stream selector expression.
+
+        eg. video.select("bestvideo[height<=720][ext=webm]+bestaudio/best")
+
+        Returns a Stream, a (video, audio) tuple of Streams for selectors
+        joining two terms with +, or None if nothing matches.  Raises
+        ValueError for an invalid selector.
+
+        """
+        return get_selector(selector).evaluate(self._stream_index)
 
     def _getvideo(self, preftype="any", ftypestrict=True, vidonly=False, quality="max"):
         """
@@ -349,24 +436,16 @@ class BasePafy(object):
 
         Select from video-only streams if vidonly is True
         """
-        streams = self.videostreams if vidonly else self.streams
-
-        if not streams:
-            return None
+        index = self._stream_index
+        ranking = index.video if vidonly else index.normal
 
         if quality == "max":
-        	r = max(streams, key=lambda x:self._sortvideokey(x, preftype=preftype, ftypestrict=ftypestrict))
+            return ranking.best(preftype, ftypestrict)
         elif quality == "min":
-        	r = min(streams, key=lambda x:self._sortvideokey(x, preftype=preftype, ftypestrict=ftypestrict))
+            return ranking.worst(preftype, ftypestrict)
         else:
             return None
 
-        if ftypestrict and preftype != "any" and r.extension != preftype:
-            return None
-
-        else:
-            return r
-
     def getbestvideo(self, preftype="any", ftypestrict=True):
         """
         Return the best resolution video-only stream.
@@ -393,62 +472,49 @@ class BasePafy(object):
     	""" Return the lowest resolution video+audio stream. """
     	return self._getvideo(preftype, ftypestrict, vidonly=False, quality="min")
 
-    def _sortaudiokey(self, x, keybitrate=0, keyftype=0, preftype="any", ftypestrict=True):
-        """ Sort function. """
-        keybitrate = int(x.rawbitrate)
-        keyftype = preftype == x.extension
-        strict, nonstrict = (keyftype, keybitrate), (keybitrate, keyftype)
-        return strict if ftypestrict else nonstrict
-
     def getbestaudio(self, preftype="any", ftypestrict=True):
         """ Return the highest bitrate audio Stream object."""
-        if not self.audiostreams:
-            return None
+        return self._stream_index.audio.best(preftype, ftypestrict)
 
-        r = max(self.audiostreams, key=lambda x:self._sortaudiokey(x, preftype=preftype, ftypestrict=ftypestrict))
+    def getworstaudio(self, preftype="any", ftypestrict=True):
+        """ Return the lowest bitrate audio Stream object."""
+        return self._stream_index.audio.worst(preftype, ftypestrict)
 
-        if ftypestrict and preftype != "any" and r.extension != preftype:
-            return None
+    def download_merged(self, filepath="", quiet=False, progress="Bytes",
+                        callback=None, meta=False, muxer="ffmpeg",
+                        video=None, audio=None):
+        """ Download video and audio streams muxed into one file.
 
-        else:
-            return r
+        The video-only and audio-only streams (by default getbestvideo()
+        and getbestaudio()) are fetched concurrently and piped straight
+        into muxer (ffmpeg or avconv).  Returns the output filepath, or
+        None if the download was cancelled.  Raises IOError if no muxer
+        could be run or muxing failed.
 
-    def getworstaudio(self, preftype="any", ftypestrict=True):
-        """ Return the lowest bitrate audio Stream object."""
-        if not self.audiostreams:
-            return None
+        """
+        video = video or self.getbestvideo()
+        audio = audio or self.getbestaudio()
 
-        r = min(self.audiostreams, key=lambda x:self._sortaudiokey(x, preftype=preftype, ftypestrict=ftypestrict))
+        if not video or not audio:
+            raise IOError("No video-only and audio-only streams to merge")
 
-        if ftypestrict and preftype != "any" and r.extension != preftype:
-            return None
+        ext = merged_extension(video, audio)
 
-        else:
-            return r
+        if not filepath or os.path.isdir(filepath):
+            filename = video.generate_filename(meta=meta,
+                                               max_length=256-len('.temp'))
+            filename = os.path.splitext(filename)[0] + "." + ext
+            filepath = os.path.join(filepath, filename)
 
-    @classmethod
-    def _content_available(cls, url):
-        try:
-            response = urlopen(url)
-        except HTTPError:
-            return False
-        else:
-            return response.getcode() < 300
+        merger = MergedDownload((video, audio), filepath, muxer=muxer,
+                                quiet=quiet, progress=progress,
+                                callback=callback)
+        return merger.run()
 
     def getbestthumb(self):
-        """ Return the best available thumbnail."""
+        """ Return the best available thumbnail. """
         if not self._bestthumb:
-            part_url = "http://i.ytimg.com/vi/%s/" % self.videoid
-            # Thumbnail resolution sorted in descending order
-            thumbs = ("maxresdefault.jpg",
-                      "sddefault.jpg",
-                      "hqdefault.jpg",
-                      "mqdefault.jpg",
-                      "default.jpg")
-            for thumb in thumbs:
-                url = part_url + thumb
-                if self._content_available(url):
-                    return url
+            self._bestthumb = get_bestthumb(self.videoid)
 
         return self._bestthumb
 
@@ -480,6 +546,7 @@ class BaseStream(object):
         self._extension = None
         self.encrypted = None
         self._notes = None
+        self._codec = None
         self._url = None
         self._rawurl = None
 
@@ -487,6 +554,8 @@ class BaseStream(object):
         self._filename = None
         self._fsize = None
         self._active = False
+        self._index_ranges = None
+        self._segment_index = None
 
     def generate_filename(self, meta=False, max_length=None):
         """ Generate filename. """
@@ -572,6 +641,11 @@ class BaseStream(object):
         """ Return additional notes regarding the stream format. """
         return self._notes
 
+    @property
+    def codec(self):
+        """ Return codec of the stream if known, eg. vp9 or opus. """
+        return self._codec
+
     @property
     def filename(self):
         """ Return filename of stream; derived from title and extension. """
@@ -594,6 +668,40 @@ class BaseStream(object):
         out = "%s:%s@%s" % (self.mediatype, self.extension, self.quality)
         return out
 
+    def _adopt(self, other):
+        """ Take the url and stream data of other, a refreshed copy. """
+        state = dict(other.__dict__)
+        state.pop('_active', None)
+        self.__dict__.update(state)
+
+    def refresh_url(self):
+        """ Re-resolve the video for a fresh url of this stream.
+
+        Raises IOError if the video no longer has a stream of this itag.
+
+        """
+        self._parent.refresh()
+
+        if not any(s is self for s in self._parent.allstreams):
+            raise IOError("Stream %s of %s is no longer available" %
+                          (self.itag, self._parent.videoid))
+
+    def _open_url(self, headers=None):
+        """ Open the stream url, refreshing it if expired or forbidden. """
+        if self._parent.expired:
+            self.refresh_url()
+
+        try:
+            return open_url(self.url, headers)
+
+        except HTTPError as e:
+            if e.getcode() != 403:
+                raise
+
+            dbg("403 for stream %s, refreshing url", self.itag)
+            self.refresh_url()
+            return open_url(self.url, headers)
+
     def get_filesize(self):
         """ Return filesize of the stream in bytes.  Set member variable. """
         if not self._fsize:
@@ -601,7 +709,7 @@ class BaseStream(object):
             try:
                 dbg("Getting stream size")
                 cl = "content-length"
-                self._fsize = int(g.opener.open(self.url).headers[cl])
+                self._fsize = int(self._open_url().headers[cl])
                 dbg("Got stream size")
 
             except (AttributeError, HTTPError, URLError):
@@ -609,6 +717,127 @@ class BaseStream(object):
 
         return self._fsize
 
+    def _expected_size(self):
+        """ Return the stream size given by YouTube, None if not known. """
+        return self._fsize or None
+
+    def open(self, retries=3, buffer_size=io.DEFAULT_BUFFER_SIZE,
+             seekable=False, hashes=None):
+        """ Return a readable binary file object streaming the stream data.
+
+        If the connection drops the stream is reopened at the current
+        position, up to retries times in a row.
+
+        Set seekable=True for a seekable file object reading only the
+        parts of the stream asked for, with HTTP Range requests.
+
+        Use hashes (hashlib names) to hash the data as it is read, the
+        digests are returned by the file object's hexdigests() method.
+
+        """
+        if seekable:
+            return io.BufferedReader(RangeReader(self.url), buffer_size)
+
+        reader = StreamReader(self.url, retries, hashes,
+                              self._expected_size(), self._open_url,
+                              duration=self._parent._length)
+        return StreamFile(reader, buffer_size)
+
+    def iter_chunks(self, chunk_size=16384, retries=3, hashes=None):
+        """ Return iterator over the stream data in chunk_size chunks.
+
+        Use hashes (hashlib names) to hash the data as it is read, the
+        digests are returned by the iterator's hexdigests() method.
+
+        """
+        reader = StreamReader(self.url, retries, hashes,
+                              self._expected_size(), self._open_url,
+                              duration=self._parent._length)
+        return ChunkIterator(reader, chunk_size)
+
+    def get_segment_index(self):
+        """ Return the stream's dash.SegmentIndex, fetching it if needed.
+
+        Raises ValueError if the stream has no segment index.
+
+        """
+        if not self._segment_index:
+            init_range, index_range = self._index_ranges or (None, None)
+            self._segment_index = dash.mp4_index(self.url, init_range,
+                                                 index_range)
+
+        return self._segment_index
+
+    def download_clip(self, start, end, filepath="", quiet=False,
+                      progress="Bytes", callback=None, meta=False):
+        """ Download start to end seconds of the stream.  Return filename.
+
+        Only the initialization data and the media segments overlapping
+        the time range are fetched, so the clip starts at or before start
+        and ends at or after end.  Raises ValueError for streams without a
+        segment index (eg. non-DASH and webm streams).
+
+        """
+        parts = self.get_segment_index().parts(start, end)
+
+        if not filepath or os.path.isdir(filepath):
+            filename = self.generate_filename(meta=meta,
+                                              max_length=256-len('.temp'))
+            base, ext = os.path.splitext(filename)
+            filename = "%s - %g-%g%s" % (base, start, end, ext)
+            filepath = os.path.join(filepath, filename)
+
+        temp_filepath = filepath + ".temp"
+        progress = progress if progress in ("KB", "MB", "GB") else "Bytes"
+        status_string = get_status_string(progress)
+        total = sum(r[1] - r[0] + 1 for _, r in parts if r) or 1
+        chunksize, bytesdone, t0 = 16384, 0, time.time()
+        self._active = True
+
+        with WriteBehind(temp_filepath, size=total) as outfh:
+            for url, brange in parts:
+                headers = brange and {"Range": "bytes=%d-%d" % brange}
+
+                with measure("download", url) as event:
+                    response = open_url(url, headers)
+                    event.status = response.getcode()
+
+                    try:
+                        while self._active:
+                            chunk = response.read(chunksize)
+
+                            if not chunk:
+                                break
+
+                            outfh.write(chunk)
+                            event.bytes += len(chunk)
+                            bytesdone += len(chunk)
+                            elapsed = time.time() - t0
+                            rate = bytesdone / 1024.0 / elapsed if elapsed \
+                                else 0
+                            progress_stats = (
+                                get_size_done(bytesdone, progress),
+                                min(1.0, bytesdone * 1.0 / total), rate, 0)
+
+                            if not quiet:
+                                status = status_string.format(*progress_stats)
+                                sys.stdout.write("\r" + status + ' ' * 4 +
+                                                 "\r")
+                                sys.stdout.flush()
+
+                            if callback:
+                                callback(total, *progress_stats)
+
+                    finally:
+                        response.close()
+
+        if not self._active:
+            os.unlink(temp_filepath)
+            return None
+
+        os.rename(temp_filepath, filepath)
+        return filepath
+
     def cancel(self):
         """ Cancel an active download. """
         if self._active:
@@ -616,11 +845,17 @@ class BaseStream(object):
             return True
 
     def download(self, filepath="", quiet=False, progress="Bytes",
-                           callback=None, meta=False, remux_audio=False):
+                           callback=None, meta=False, remux_audio=False,
+                           hashes=None):
         """ Download.  Use quiet=True to supress output. Return filename.
 
         Use meta=True to append video id and itag to generated filename
         Use remax_audio=True to remux audio file downloads
+        Use hashes (hashlib names, eg. ["sha256"]) to hash the downloaded
+        data as it arrives, a (filename, {name: hexdigest}) tuple is then
+        returned
+
+        Raises IOError if less data than the stream size is received.
 
         """
         # pylint: disable=R0912,R0914
@@ -645,9 +880,11 @@ class BaseStream(object):
 
         status_string = get_status_string(progress)
 
-        response = g.opener.open(self.url)
+        response = self._open_url()
         total = int(response.info()['Content-Length'].strip())
+        check_size(total, self._expected_size())
         chunksize, bytesdone, t0 = 16384, 0, time.time()
+        hasher = Hashes(hashes) if hashes else None
 
         fmode, offset = "wb", 0
 
@@ -657,75 +894,509 @@ class BaseStream(object):
                 offset = os.stat(temp_filepath).st_size
                 fmode = "ab"
 
-        outfh = open(temp_filepath, fmode)
+        outfh = WriteBehind(temp_filepath, fmode, size=total, hashes=hasher)
 
         if offset:
             # partial file exists, resume download
-            resuming_opener = build_opener()
-            resuming_opener.addheaders = [('User-Agent', g.user_agent),
-                                          ("Range", "bytes=%s-" % offset)]
-            response = resuming_opener.open(self.url)
+            response.close()
+            response = None
             bytesdone = offset
 
+        # reopens the url at the current offset if the connection drops or
+        # is throttled, refreshing it if it has expired
+        reader = StreamReader(self.url, opener=self._open_url, offset=offset,
+                              response=response, duration=self._parent._length)
+
+        streamer = None
+
+        if remux_audio and self.mediatype == "audio" and not offset:
+            # remux while downloading, the muxer needs the whole stream so
+            # resumed downloads are remuxed once complete
+            streamer = StreamingRemux(filepath, muxer=remux_audio)
+
         self._active = True
 
-        while self._active:
-            chunk = response.read(chunksize)
-            outfh.write(chunk)
-            elapsed = time.time() - t0
-            bytesdone += len(chunk)
-            if elapsed:
-                rate = ((float(bytesdone) - float(offset)) / 1024.0) / elapsed
-                eta = (total - bytesdone) / (rate * 1024)
-            else:  # Avoid ZeroDivisionError
-                rate = 0
-                eta = 0
-
-            progress_stats = (get_size_done(bytesdone, progress),
-                              bytesdone * 1.0 / total, rate, eta)
-
-            if not chunk:
+        try:
+            while self._active:
+                chunk = reader.read(chunksize)
+                outfh.write(chunk)
+
+                if streamer:
+                    streamer.write(chunk)
+
+                elapsed = time.time() - t0
+                bytesdone += len(chunk)
+                if elapsed:
+                    rate = ((float(bytesdone) - float(offset)) / 1024.0) / elapsed
+                    eta = (total - bytesdone) / (rate * 1024)
+                else:  # Avoid ZeroDivisionError
+                    rate = 0
+                    eta = 0
+
+                progress_stats = (get_size_done(bytesdone, progress),
+                                  bytesdone * 1.0 / total, rate, eta)
+
+                if not chunk:
+                    outfh.close()
+                    break
+
+                if not quiet:
+                    status = status_string.format(*progress_stats)
+                    sys.stdout.write("\r" + status + ' ' * 4 + "\r")
+                    sys.stdout.flush()
+
+                if callback:
+                    callback(total, *progress_stats)
+
+        except BaseException:
+            # keep what was received for resuming: closing truncates the
+            # preallocated file to the data written, also on Ctrl-C
+            reader.close()
+
+            if streamer:
+                streamer.abort()
+
+            try:
                 outfh.close()
-                break
 
-            if not quiet:
-                status = status_string.format(*progress_stats)
-                sys.stdout.write("\r" + status + ' ' * 4 + "\r")
-                sys.stdout.flush()
+            except (IOError, OSError) as e:
+                dbg("closing %s failed: %s", temp_filepath, e)
 
-            if callback:
-                callback(total, *progress_stats)
+            raise
 
         if self._active:
 
-            if remux_audio and self.mediatype == "audio":
+            if bytesdone != total:
+                if streamer:
+                    streamer.abort()
+
+                raise IOError("Download incomplete, received %d of %d bytes"
+                              % (bytesdone, total))
+
+            if streamer and streamer.finish():
+                os.unlink(temp_filepath)
+
+                if not quiet:
+                    sys.stdout.write("\nAudio remuxed.\n")
+
+            elif remux_audio and self.mediatype == "audio":
                 remux(temp_filepath, filepath, quiet=quiet, muxer=remux_audio)
 
             else:
                 os.rename(temp_filepath, filepath)
 
-            return filepath
+            return (filepath, hasher.hexdigests()) if hasher else filepath
 
         else:  # download incomplete, return temp filepath
             outfh.close()
-            return temp_filepath
+            reader.close()
+
+            if streamer:
+                streamer.abort()
+
+            return (temp_filepath, None) if hasher else temp_filepath
+
+
+def muxers(muxer="ffmpeg"):
+    """ Return the muxer tools to try, preferred muxer first. """
+    muxer = muxer if isinstance(muxer, (str, uni)) else "ffmpeg"
+    tools = []
+
+    for tool in (muxer, "ffmpeg", "avconv"):
+        if tool not in tools:
+            tools.append(tool)
+
+    return tools
+
+
+class StreamReader(io.RawIOBase):
+
+    """ Raw reader of a stream url, resuming with a Range request on errors.
+
+    A dropped connection (a retryable error or a response ending before
+    its Content-Length) is reopened at the current offset, up to retries
+    times without progress in between.
+
+    opener(headers) opens the url, open_url by default.  Reading starts
+    at offset, from response if given, which must be positioned there.
+
+    If duration (seconds of media) is given, a connection delivering less
+    than g.throttle_factor times the playback rate for g.throttle_window
+    seconds is taken to be throttled and reopened at the current offset,
+    up to g.throttle_reconnects times.
+
+    A download Event is emitted at the end of the stream, on an error or
+    when the reader is closed.
+
+    """
+
+    def __init__(self, url, retries=3, hashes=None, size=None, opener=None,
+                 offset=0, response=None, duration=None):
+        """ Open url, check its length against size if given. """
+        super(StreamReader, self).__init__()
+        self.url = url
+        self.retries = retries
+        self.pos = offset
+        self.length = None
+        self.reconnects = 0
+        self._hashes = Hashes(hashes) if hashes else None
+        self._opener = opener or (lambda headers: open_url(url, headers))
+        self._event = Event("download", url)
+        self._start, self._offset = time.time(), offset
+        self._response = self._open(response)
+        check_size(self.length, size)
+        min_rate = None
+
+        if duration and self.length and g.throttle_factor:
+            min_rate = g.throttle_factor * self.length / float(duration)
+
+        self._monitor = ThroughputMonitor(min_rate)
+
+    def hexdigests(self):
+        """ Return dict of hash name: hex digest of the data read so far. """
+        return self._hashes.hexdigests() if self._hashes else {}
+
+    def _open(self, response=None):
+        """ Open url at the current position, return response. """
+        if response is None:
+            headers = {"Range": "bytes=%d-" % self.pos} if self.pos else None
+            response = self._opener(headers)
+
+            if self.pos and response.getcode() != 206:
+                response.close()
+                raise IOError("Cannot resume %s, server ignored Range" %
+                              self.url)
+
+        if self.length is None:
+            length = response.info().get('Content-Length')
+            self.length = self.pos + int(length) if length else None
+
+        if self._event:
+            self._event.status = response.getcode()
+
+        return response
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def _finish(self, error=None):
+        """ Emit the download event, once. """
+        if self._event:
+            self._event.bytes = self.pos - self._offset
+            self._event.duration = time.time() - self._start
+            self._event.error = error
+            emit(self._event)
+            self._event = None
+
+    def readinto(self, b):
+        """ Read up to len(b) bytes into b, return number of bytes read. """
+        try:
+            nbytes = self._readinto(b)
+
+        except Exception as e:
+            self._finish(e)
+            raise
+
+        if not nbytes and len(b):
+            self._finish()
+
+        return nbytes
+
+    def _readinto(self, b):
+        """ Read into b, resuming the connection if it drops. """
+        failures = 0
+
+        while True:
+            start = time.time()
+
+            try:
+                chunk = self._response.read(len(b))
+
+            except Exception as e:  # pylint: disable=W0703
+                if not retry_policy.retryable(e):
+                    raise
+
+                error = e
+
+            else:
+                if chunk or self.length is None or self.pos >= self.length:
+                    b[:len(chunk)] = chunk
+                    self.pos += len(chunk)
+
+                    if self._hashes:
+                        self._hashes.update(chunk)
+
+                    if self._monitor.update(len(chunk),
+                                            time.time() - start):
+                        self._reconnect()
+
+                    return len(chunk)
+
+                error = IOError("Connection closed at byte %d of %d" %
+                                (self.pos, self.length))
+
+            failures += 1
+
+            if failures > self.retries:
+                if isinstance(error, IOError):
+                    raise error
+
+                raise IOError("Reading %s failed: %r" % (self.url, error))
+
+            dbg("stream read failed (%s), resuming at byte %d", error,
+                self.pos)
+            self._response.close()
+            self._response = self._open()
+            self._monitor.reset()
+
+    def _reconnect(self):
+        """ Reopen a throttled connection at the current position. """
+        if self.pos >= self.length or \
+                self.reconnects >= g.throttle_reconnects:
+            return
+
+        dbg("stream throttled, reconnecting at byte %d", self.pos)
+        self._response.close()
+        self._response = self._open()
+        self.reconnects += 1
+        throughput_stats.record_reconnect()
+
+    def close(self):
+        if not self.closed:
+            self._response.close()
+            self._finish()
+
+        super(StreamReader, self).close()
+
+
+class StreamFile(io.BufferedReader):
+
+    """ Buffered StreamReader, as returned by Stream.open(). """
+
+    def hexdigests(self):
+        """ Return dict of hash name: hex digest of the data read so far. """
+        return self.raw.hexdigests()
+
+
+class ChunkIterator(object):
+
+    """ Iterator over the chunks read from a StreamReader. """
+
+    def __init__(self, reader, chunk_size):
+        self.reader = reader
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.reader.read(self.chunk_size)
+
+        if not chunk:
+            self.reader.close()
+            raise StopIteration
+
+        return chunk
+
+    next = __next__
+
+    def hexdigests(self):
+        """ Return dict of hash name: hex digest of the data read so far. """
+        return self.reader.hexdigests()
+
+    def close(self):
+        self.reader.close()
+
+
+def check_size(length, expected):
+    """ Raise IOError if both sizes are known and differ. """
+    if length and expected and length != expected:
+        raise IOError("Stream size mismatch, %d bytes sent, %d expected" %
+                      (length, expected))
+
+
+class RangeReader(io.RawIOBase):
+
+    """ Seekable raw reader of a stream url using HTTP Range requests.
+
+    Data is fetched in blocks of block_size bytes, the last cache_blocks
+    of which are kept.  While reading sequentially, up to readahead blocks
+    are fetched with each request.  If the server does not send the stream
+    length, length is None until the end of the stream has been read, and
+    seeking relative to the end raises IOError.
+
+    """
+
+    def __init__(self, url, block_size=262144, cache_blocks=16, readahead=8):
+        """ Set initial values, fetching the first block. """
+        super(RangeReader, self).__init__()
+        self.url = url
+        self.block_size = block_size
+        self.cache_blocks = max(cache_blocks, readahead)
+        self.readahead = readahead
+        self.pos = 0
+        self.length = None
+        self.requests = 0
+        self._blocks = {}
+        self._lru = []
+        self._last = None
+        self._fetch(0, 1)
+
+    def _fetch(self, first, count):
+        """ Fetch count blocks from block first into the cache. """
+        start = first * self.block_size
+        end = start + count * self.block_size - 1
+
+        if self.length is not None:
+            end = min(end, self.length - 1)
+
+        request = build_request(self.url, {"Range": "bytes=%d-%d" %
+                                           (start, end)})
+
+        def fetch():
+            response = g.opener.open(request)
+
+            try:
+                if response.info().get("Content-Range"):
+                    return response.info(), response.read()
+
+                # Range was ignored, do not read the whole stream
+                return response.info(), response.read(self.block_size + 1)
+
+            finally:
+                response.close()
+
+        try:
+            info, data = retry_policy.call(fetch, self.url)
+
+        except HTTPError as e:
+            if e.getcode() != 416 or self.length is not None:
+                raise
+
+            # read past the end of a stream of unknown length
+            self.length = start
+            return
+
+        finally:
+            self.requests += 1
+
+        content_range = info.get("Content-Range")
+
+        if content_range:
+            total = content_range.rsplit("/", 1)[1]
+
+            if total != "*":
+                self.length = int(total)
+
+            elif len(data) < end - start + 1:
+                self.length = start + len(data)
+
+        elif start == 0 and len(data) <= self.block_size:
+            # server ignored Range, the stream fits in one block
+            self.length = len(data)
+
+        else:
+            raise IOError("Range requests not supported for %s" % self.url)
+
+        for n in range(0, len(data), self.block_size):
+            self._store(first + n // self.block_size,
+                        data[n:n + self.block_size])
+
+    def _store(self, index, data):
+        """ Cache block index, evicting the least recently used. """
+        if index in self._blocks:
+            self._lru.remove(index)
+
+        self._blocks[index] = data
+        self._lru.append(index)
+
+        while len(self._lru) > self.cache_blocks:
+            del self._blocks[self._lru.pop(0)]
+
+    def _block(self, index):
+        """ Return block index, fetching it and any read-ahead blocks. """
+        if index not in self._blocks:
+            sequential = self._last is not None and index == self._last + 1
+            count = self.readahead if sequential else 1
+            last = None
+
+            if self.length is not None:
+                last = (self.length - 1) // self.block_size
+
+            while count > 1 and ((last is not None and
+                                  index + count - 1 > last) or
+                                 index + count - 1 in self._blocks):
+                count -= 1
+
+            self._fetch(index, count)
+
+        else:
+            self._lru.remove(index)
+            self._lru.append(index)
+
+        self._last = index
+        return self._blocks.get(index, b"")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        """ Move to offset relative to whence, return new position. """
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+
+        elif whence == io.SEEK_END:
+            if self.length is None:
+                raise IOError("Length of %s unknown" % self.url)
+
+            offset += self.length
+
+        if offset < 0:
+            raise ValueError("Negative seek position %d" % offset)
+
+        self.pos = offset
+        return self.pos
+
+    def readinto(self, b):
+        """ Read up to len(b) bytes into b, return number of bytes read. """
+        if not len(b) or (self.length is not None and
+                          self.pos >= self.length):
+            return 0
+
+        index, skip = divmod(self.pos, self.block_size)
+        data = self._block(index)[skip:skip + len(b)]
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
 
 
 def remux(infile, outfile, quiet=False, muxer="ffmpeg"):
     """ Remux audio. """
-    muxer = muxer if isinstance(muxer, str) else "ffmpeg"
-
-    for tool in set([muxer, "ffmpeg", "avconv"]):
+    for tool in muxers(muxer):
         cmd = [tool, "-y", "-i", infile, "-acodec", "copy", "-vn", outfile]
 
         try:
             with open(os.devnull, "w") as devnull:
-                subprocess.call(cmd, stdout=devnull, stderr=subprocess.STDOUT)
+                status = subprocess.call(cmd, stdout=devnull,
+                                         stderr=subprocess.STDOUT)
 
         except OSError:
             dbg("Failed to remux audio using %s", tool)
 
         else:
+            if status:
+                dbg("%s exited with status %d remuxing audio", tool, status)
+                continue
+
             os.unlink(infile)
             dbg("remuxed audio file using %s" % tool)
 
@@ -739,6 +1410,327 @@ def remux(infile, outfile, quiet=False, muxer="ffmpeg"):
         os.rename(infile, outfile)
 
 
+class StreamingRemux(object):
+
+    """ Remux audio fed to the muxer's stdin chunk by chunk.
+
+    Used by download(remux_audio=True) so remuxing completes along with
+    the download instead of re-reading the whole file afterwards.  If no
+    muxer can be started or it fails, finish() returns False and the
+    caller falls back to remux().
+
+    """
+
+    def __init__(self, outfile, muxer="ffmpeg"):
+        """ Start the first muxer that runs, writing outfile. """
+        self.outfile = outfile
+        self.proc = self.tool = None
+
+        for tool in muxers(muxer):
+            cmd = [tool, "-y", "-i", "pipe:0", "-acodec", "copy", "-vn",
+                   outfile]
+
+            try:
+                with open(os.devnull, "w") as devnull:
+                    self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                                 stdout=devnull,
+                                                 stderr=subprocess.STDOUT)
+
+            except OSError:
+                dbg("Failed to start streaming remux using %s", tool)
+
+            else:
+                dbg("remuxing audio while downloading using %s", tool)
+                self.tool = tool
+                break
+
+    def write(self, chunk):
+        """ Pass chunk to the muxer, abort if it has failed. """
+        if self.proc:
+            try:
+                self.proc.stdin.write(chunk)
+
+            except (IOError, OSError):
+                dbg("streaming remux using %s failed", self.tool)
+                self.abort()
+
+    def finish(self):
+        """ End of input, wait for the muxer.  Return True on success. """
+        if not self.proc:
+            return False
+
+        try:
+            self.proc.stdin.close()
+
+        except (IOError, OSError):
+            pass
+
+        status = self.proc.wait()
+        self.proc = None
+
+        if status:
+            dbg("streaming remux using %s exited with status %d",
+                self.tool, status)
+            self._remove_output()
+
+        return not status
+
+    def abort(self):
+        """ Stop the muxer and remove its partial output. """
+        if self.proc:
+            try:
+                self.proc.stdin.close()
+
+            except (IOError, OSError):
+                pass
+
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+            self._remove_output()
+
+    def _remove_output(self):
+        if os.path.exists(self.outfile):
+            os.unlink(self.outfile)
+
+
+def merged_extension(video, audio):
+    """ Return the container extension for muxing video and audio. """
+    if video.extension in ("mp4", "m4v") and audio.extension == "m4a":
+        return "mp4"
+
+    elif video.extension == "webm" and audio.extension == "webm":
+        return "webm"
+
+    return "mkv"
+
+
+_MUX_FORMATS = {"mp4": "mp4", "webm": "webm", "mkv": "matroska"}
+
+
+class MergedDownload(object):
+
+    """ Fetch several streams concurrently and mux them into one file.
+
+    Each stream is copied by its own thread into a named pipe read by the
+    muxer, so nothing but the output file is written to disk.  Where named
+    pipes are not available (Windows) the streams are still fetched
+    concurrently, into temporary files muxed once both are complete.
+
+    """
+
+    chunksize = 16384
+
+    def __init__(self, streams, filepath, muxer="ffmpeg", quiet=False,
+                 progress="Bytes", callback=None):
+        self.streams = list(streams)
+        self.filepath = filepath
+        self.muxer = muxer
+        self.quiet = quiet
+        self.progress = progress if progress in ("KB", "MB", "GB") \
+            else "Bytes"
+        self.callback = callback
+        self.errors = []
+        self.stopped = False
+        self.total = self.bytesdone = 0
+        self._lock = threading.Lock()
+        self._status_string = get_status_string(self.progress)
+
+    def run(self):
+        """ Download and mux.  Return filepath, None if cancelled. """
+        responses = []
+
+        try:
+            for stream in self.streams:
+                responses.append(open_url(stream.url))
+
+            return self._run(responses)
+
+        finally:
+            for response in responses:
+                response.close()
+
+    def _run(self, responses):
+        """ Download responses and mux them. """
+        self.total = sum(int(r.info()['Content-Length'].strip())
+                         for r in responses)
+        ext = os.path.splitext(self.filepath)[1].lstrip(".")
+        temp_filepath = self.filepath + ".temp"
+        piped = hasattr(os, "mkfifo")
+        self.t0 = time.time()
+
+        for stream in self.streams:
+            stream._active = True
+
+        if piped:
+            tmpdir = tempfile.mkdtemp(prefix="pafy")
+            sources = [os.path.join(tmpdir, "stream%d" % n)
+                       for n in range(len(self.streams))]
+
+            for source in sources:
+                os.mkfifo(source)
+
+        else:
+            sources = ["%s.%d.temp" % (self.filepath, n)
+                       for n in range(len(self.streams))]
+
+        try:
+            if piped:
+                proc = self._start_muxer(sources, temp_filepath, ext)
+                threads = self._start_fetch(responses, sources)
+                proc.wait()
+                cancelled = not all(s._active for s in self.streams)
+                self._release(sources)
+
+            else:
+                threads = self._start_fetch(responses, sources)
+
+                for thread in threads:
+                    thread.join()
+
+                cancelled = not all(s._active for s in self.streams)
+                proc = None
+
+                if not cancelled and not self.errors:
+                    proc = self._start_muxer(sources, temp_filepath, ext)
+                    proc.wait()
+
+            for thread in threads:
+                thread.join()
+
+            if self.errors:
+                raise self.errors[0]
+
+            if cancelled:
+                dbg("merged download cancelled")
+                return None
+
+            if proc.returncode:
+                raise IOError("Muxing failed, %s exited with status %d" %
+                              (self._tool, proc.returncode))
+
+            os.rename(temp_filepath, self.filepath)
+
+            if not self.quiet:
+                sys.stdout.write("\nStreams merged.\n")
+
+            return self.filepath
+
+        finally:
+            for path in [temp_filepath] + ([] if piped else sources):
+                if os.path.exists(path):
+                    os.unlink(path)
+
+            if piped:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _start_muxer(self, sources, outfile, ext):
+        """ Start muxer reading sources, writing outfile.  Return Popen. """
+        for tool in muxers(self.muxer):
+            cmd = [tool, "-y"]
+
+            for source in sources:
+                cmd += ["-i", source]
+
+            cmd += ["-map", "0:v", "-map", "1:a", "-c", "copy",
+                    "-f", _MUX_FORMATS.get(ext, "matroska"), outfile]
+
+            try:
+                with open(os.devnull, "w") as devnull:
+                    proc = subprocess.Popen(cmd, stdin=devnull,
+                                            stdout=devnull,
+                                            stderr=subprocess.STDOUT)
+
+            except OSError:
+                dbg("Failed to start muxer %s", tool)
+
+            else:
+                dbg("muxing streams using %s" % tool)
+                self._tool = tool
+                return proc
+
+        raise IOError("No muxer found, tried %s" %
+                      ", ".join(muxers(self.muxer)))
+
+    def _start_fetch(self, responses, sources):
+        """ Start a thread copying each response to its source. """
+        threads = []
+
+        for stream, response, source in zip(self.streams, responses,
+                                            sources):
+            thread = threading.Thread(target=self._fetch,
+                                      args=(stream, response, source))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        return threads
+
+    def _fetch(self, stream, response, path):
+        """ Copy response to path while stream is active. """
+        try:
+            with measure("download", stream.url) as event:
+                event.status = response.getcode()
+
+                with open(path, "wb") as outfh:
+                    while stream._active and not self.stopped:
+                        chunk = response.read(self.chunksize)
+
+                        if not chunk:
+                            break
+
+                        outfh.write(chunk)
+                        event.bytes += len(chunk)
+                        self._report(len(chunk))
+
+        except Exception as e:  # pylint: disable=W0703
+            if not self.stopped:
+                dbg("merged download failed: %s", e)
+                self.errors.append(e)
+
+            # stop the other streams
+            self.stopped = True
+
+    def _release(self, fifos):
+        """ Unblock fetch threads after the muxer exited, remove fifos. """
+        self.stopped = True
+
+        for fifo in fifos:
+            try:
+                os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                os.unlink(fifo)
+
+            except OSError:
+                pass
+
+    def _report(self, nbytes):
+        """ Account nbytes received, show progress and call callback. """
+        with self._lock:
+            self.bytesdone += nbytes
+            bytesdone, total = self.bytesdone, self.total
+
+        elapsed = time.time() - self.t0
+
+        if elapsed and bytesdone:
+            rate = (float(bytesdone) / 1024.0) / elapsed
+            eta = (total - bytesdone) / (rate * 1024)
+
+        else:  # Avoid ZeroDivisionError
+            rate = 0
+            eta = 0
+
+        progress_stats = (get_size_done(bytesdone, self.progress),
+                          bytesdone * 1.0 / total, rate, eta)
+
+        if not self.quiet:
+            status = self._status_string.format(*progress_stats)
+            sys.stdout.write("\r" + status + ' ' * 4 + "\r")
+            sys.stdout.flush()
+
+        if self.callback:
+            self.callback(total, *progress_stats)
+
+
 def get_size_done(bytesdone, progress):
     _progress_dict = {'KB': 1024.0, 'MB': 1048576.0, 'GB': 1073741824.0}
     return round(bytesdone/_progress_dict.get(progress, 1.0), 2)
@@ -2,17 +2,26 @@ import sys
 import time
 import logging
 import os
+import threading
+from contextlib import contextmanager
 
 if sys.version_info[:2] >= (3, 0):
     # pylint: disable=E0611,F0401,I0011
+    from collections.abc import Mapping
+    from urllib.error import HTTPError
     uni = str
 else:
+    from collections import Mapping
+    from urllib2 import HTTPError
     uni = unicode
 
 import youtube_dl
 
-from . import g
+from . import g, dash
 from .backend_shared import BasePafy, BaseStream, remux, get_status_string, get_size_done
+from .backend_shared import check_size, timed_fetch
+from .util import Hashes
+from .instrument import measure, timed
 
 dbg = logging.debug
 
@@ -20,40 +29,238 @@ dbg = logging.debug
 early_py_version = sys.version_info[:2] < (2, 7)
 
 
+def _freeze(value):
+    """ Return a hashable equivalent of an option value. """
+    if isinstance(value, Mapping):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+
+    return value
+
+
+class YdlOptions(Mapping):
+
+    """ Immutable, hashable set of youtube-dl options.
+
+    Reads like a dict; merge() returns a new set with some options
+    overridden.  Equal option sets hash equally, so a YdlOptions can key
+    caches of YoutubeDL instances or resolved info.
+
+    """
+
+    def __init__(self, opts=None):
+        """ Set initial values. """
+        self._opts = dict(opts or {})
+        self._key = _freeze(self._opts)
+        self._hash = hash(self._key)
+
+    def merge(self, overrides=None):
+        """ Return a new YdlOptions with overrides applied. """
+        if not overrides:
+            return self
+
+        opts = dict(self._opts)
+        opts.update(overrides)
+        return YdlOptions(opts)
+
+    def as_dict(self):
+        """ Return the options as a new dict. """
+        return dict(self._opts)
+
+    def __getitem__(self, key):
+        return self._opts[key]
+
+    def __iter__(self):
+        return iter(self._opts)
+
+    def __len__(self):
+        return len(self._opts)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, YdlOptions):
+            return NotImplemented
+        return self._key == other._key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "YdlOptions(%r)" % self._opts
+
+
+class YdlPool(object):
+
+    """ Pool of long-lived YoutubeDL instances keyed by YdlOptions.
+
+    YoutubeDL instances are not safe for concurrent use, so each one is
+    checked out by a single caller at a time.  checkout() hands out an idle
+    instance created with the same options, or a new one if none is idle,
+    and keeps up to maxidle instances per option set for reuse afterwards.
+
+    """
+
+    def __init__(self, maxidle=4):
+        """ Set initial values. """
+        self.maxidle = maxidle
+        self.created = 0
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    @contextmanager
+    def checkout(self, opts):
+        """ Context manager yielding a YoutubeDL instance for opts. """
+        key = opts if isinstance(opts, YdlOptions) else YdlOptions(opts)
+
+        with self._lock:
+            idle = self._idle.get(key)
+            ydl = idle.pop() if idle else None
+
+        if ydl is None:
+            ydl = youtube_dl.YoutubeDL(key.as_dict())
+
+            with self._lock:
+                self.created += 1
+
+        try:
+            yield ydl
+
+        finally:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                keep = len(idle) < self.maxidle
+
+                if keep:
+                    idle.append(ydl)
+
+            if not keep:
+                ydl.__exit__(None, None, None)
+
+    def clear(self):
+        """ Close and drop all idle instances. """
+        with self._lock:
+            instances = [y for idle in self._idle.values() for y in idle]
+            self._idle = {}
+
+        for ydl in instances:
+            ydl.__exit__(None, None, None)
+
+
+ydl_pool = YdlPool()
+
+
+# Format fields used by YtdlStream, the rest is dropped from retained info
+_FORMAT_FIELDS = ('format_id', 'ext', 'url', 'fragment_base_url',
+                  'acodec', 'vcodec', 'abr', 'width', 'height',
+                  'format_note', 'filesize')
+
+
+def _fragment_list(fmt):
+    """ Return list of (path, duration) fragments of a segmented format. """
+    if not (fmt.get('fragment_base_url') and fmt.get('fragments')):
+        return None
+
+    return [(f.get('path') or f.get('url'), f.get('duration'))
+            for f in fmt['fragments']]
+
+
+def _compact_formats(info):
+    """ Return list of compact format records from a youtube-dl info dict.
+
+    The fragments of segmented formats are kept as (path, duration) tuples
+    under 'fragment_list'.  The raw format dicts are returned if
+    g.keep_ydl_info is set.
+
+    """
+    formats = info.get('formats') or []
+
+    if g.keep_ydl_info:
+        return formats
+
+    compact = []
+
+    for f in formats:
+        record = dict((k, f[k]) for k in _FORMAT_FIELDS if k in f)
+        fragments = _fragment_list(f)
+
+        if fragments:
+            record['fragment_list'] = fragments
+
+        compact.append(record)
+
+    return compact
+
+
 class YtdlPafy(BasePafy):
     def __init__(self, *args, **kwargs):
         self._ydl_info = None
-        self._ydl_opts = g.def_ydl_opts
-        ydl_opts = kwargs.get("ydl_opts")
-        if ydl_opts:
-            self._ydl_opts.update(ydl_opts)
+        self._ydl_formats = []
+        self._flat_formats = None  # raw formats of a flat extraction
+        self._ydl_opts = YdlOptions(g.def_ydl_opts).merge(
+            kwargs.get("ydl_opts"))
         super(YtdlPafy, self).__init__(*args, **kwargs)
 
+    def _extract_info(self, opts, process=True):
+        """ Return youtube-dl info dict for the video. """
+        with ydl_pool.checkout(opts) as ydl:
+            try:
+                return ydl.extract_info(self.videoid, download=False,
+                                        process=process)
+            # Turn into an IOError since that is what pafy previously raised
+            except youtube_dl.utils.DownloadError as e:
+                raise IOError(str(e).replace('YouTube said', 'Youtube says'))
+
+    @timed_fetch
     def _fetch_basic(self):
         """ Fetch basic data and streams. """
         if self._have_basic:
             return
 
-        with youtube_dl.YoutubeDL(self._ydl_opts) as ydl:
-            try:
-                self._ydl_info = ydl.extract_info(self.videoid, download=False)
-            # Turn into an IOError since that is what pafy previously raised
-            except youtube_dl.utils.DownloadError as e:
-                raise IOError(str(e).replace('YouTube said', 'Youtube says'))
+        if self._flat:
+            opts = self._ydl_opts.merge(g.flat_ydl_opts)
+
+            with timed("extract"):
+                info = self._extract_info(opts, process=False)
+
+            # compacted when the streams are first used
+            self._flat_formats = info.get('formats') or []
+
+        else:
+            with timed("extract"):
+                info = self._extract_info(self._ydl_opts)
+
+            with timed("formats"):
+                self._ydl_formats = _compact_formats(info)
+
+        # The full info dict is large, only keep it if asked to
+        self._ydl_info = info if g.keep_ydl_info else None
 
         if self.callback:
             self.callback("Fetched video info")
 
-        self._title = self._ydl_info['title']
-        self._author = self._ydl_info['uploader']
-        self._rating = self._ydl_info['average_rating']
-        self._length = self._ydl_info['duration']
-        self._viewcount = self._ydl_info['view_count']
-        self._likes = self._ydl_info.get('like_count', 0)
-        self._dislikes = self._ydl_info.get('dislike_count', 0)
-        self._username = self._ydl_info['uploader_id']
-        self._category = self._ydl_info['categories'][0] if self._ydl_info['categories'] else ''
-        self._bestthumb = self._ydl_info['thumbnails'][0]['url']
+        thumbnails = info.get('thumbnails') or [{'url': info.get('thumbnail')}]
+        self._title = info['title']
+        self._author = info.get('uploader')
+        self._rating = info.get('average_rating')
+        self._length = info.get('duration')
+        self._viewcount = info.get('view_count')
+        self._likes = info.get('like_count', 0)
+        self._dislikes = info.get('dislike_count', 0)
+        self._username = info.get('uploader_id')
+        self._category = info['categories'][0] if info.get('categories') else ''
+        self._bestthumb = thumbnails[0]['url']
         self._bigthumb = g.urls['bigthumb'] % self.videoid
         self._bigthumbhd = g.urls['bigthumbhd'] % self.videoid
         self.expiry = time.time() + g.lifespan
@@ -79,13 +286,37 @@ class YtdlPafy(BasePafy):
         if not self._have_basic:
             self._fetch_basic()
 
-        allstreams = [YtdlStream(z, self) for z in self._ydl_info['formats']]
+        if self._flat:
+            # The flat extraction returned the formats unprocessed, they
+            # hold all fields pafy uses.  refresh() extracts them again
+            with timed("formats", self.timings):
+                self._ydl_formats = _compact_formats(
+                    {'formats': self._flat_formats})
+
+            self._flat_formats = None
+            self._flat = False
+
+        with timed("streams", self.timings):
+            allstreams = [YtdlStream(z, self) for z in self._ydl_formats]
+
         self._streams = [i for i in allstreams if i.mediatype == 'normal']
         self._audiostreams = [i for i in allstreams if i.mediatype == 'audio']
         self._videostreams = [i for i in allstreams if i.mediatype == 'video']
         self._m4astreams = [i for i in allstreams if i.extension == 'm4a']
         self._oggstreams = [i for i in allstreams if i.extension == 'ogg']
         self._allstreams = allstreams
+        self._build_index()
+
+
+def _hash_file(filename, names):
+    """ Return dict of hash name: hex digest of the data in filename. """
+    hasher = Hashes(names)
+
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1048576), b""):
+            hasher.update(chunk)
+
+    return hasher.hexdigests()
 
 
 class YtdlStream(BaseStream):
@@ -114,12 +345,23 @@ class YtdlStream(BaseStream):
 
         self._extension = info['ext']
         self._notes = info.get('format_note') or ''
+        codec = info.get('acodec' if self._mediatype == 'audio' else 'vcodec')
+        self._codec = codec if codec not in (None, 'none') else ''
         self._url = info.get('url')
         if self._url.startswith("https://manifest.googlevideo.com"):
             self._url = info.get('fragment_base_url', self._url)
 
+        self._fragments = info.get('fragment_list') or _fragment_list(info)
         self._info = info
 
+    def get_segment_index(self):
+        """ Return the stream's dash.SegmentIndex, fetching it if needed. """
+        if self._fragments and not self._segment_index:
+            self._segment_index = dash.fragment_index(
+                self._info['fragment_base_url'], self._fragments)
+
+        return super(YtdlStream, self).get_segment_index()
+
     def get_filesize(self):
         """ Return filesize of the stream in bytes.  Set member variable. """
 
@@ -130,8 +372,23 @@ class YtdlStream(BaseStream):
         # Fallback
         return super(YtdlStream, self).get_filesize()
 
+    def _expected_size(self):
+        """ Return the stream size given by YouTube, None if not known. """
+        return self._info.get('filesize') or None
+
     def download(self, filepath="", quiet=False, progress="Bytes",
-                 callback=None, meta=False, remux_audio=False):
+                 callback=None, meta=False, remux_audio=False, hashes=None):
+        """ Download the stream, see BaseStream.download.
+
+        Segmented formats (with a fragment_base_url) have no single url
+        to fetch and are downloaded by youtube-dl's http downloader, their
+        hashes computed once the download completes.
+
+        """
+        if not self._info.get('fragment_base_url'):
+            return super(YtdlStream, self).download(
+                filepath, quiet, progress, callback, meta, remux_audio,
+                hashes)
 
         downloader = youtube_dl.downloader.http.HttpFD(ydl(),
             {'http_chunk_size': 10485760})
@@ -177,15 +434,51 @@ class YtdlStream(BaseStream):
         else:
             filepath = self.generate_filename(meta=meta, max_length=256 - len('.temp'))
 
-        infodict = {'url': self.url}
+        if self._parent.expired:
+            self.refresh_url()
+
+        # youtube-dl writes to a .part file, resumed if it exists
+        partfile = filepath + ".part"
+        start = os.path.getsize(partfile) if os.path.exists(partfile) else 0
+
+        with measure("download", self.url) as event:
+            try:
+                for attempt in range(2):
+                    try:
+                        downloader.download(filepath, {'url': self.url})
+                        break
+
+                    except HTTPError as e:
+                        # the url expired, HttpFD resumes from the .part file
+                        if e.getcode() != 403 or attempt:
+                            raise
+
+                        dbg("403 for stream %s, refreshing url", self.itag)
+                        self.refresh_url()
+
+            finally:
+                done = filepath if os.path.exists(filepath) else partfile
+
+                if os.path.exists(done):
+                    event.bytes = os.path.getsize(done) - start
 
-        downloader.download(filepath, infodict)
         print("")
 
+        if os.path.exists(filepath):
+            check_size(os.path.getsize(filepath), self._expected_size())
+
+        digests = None
+
+        if hashes and os.path.exists(filepath):
+            digests = _hash_file(filepath, hashes)
+
         if remux_audio and self.mediatype == "audio":
             os.rename(filepath, filepath + '.temp')
             remux(filepath + '.temp', filepath, quiet=quiet, muxer=remux_audio)
 
+        if hashes:
+            return filepath, digests
+
         return filepath
 
 
@@ -1,7 +1,9 @@
 import re
+import sys
 from .pafy import call_gdata
 from .playlist import Playlist
-from .backend_shared import pyver
+
+pyver = 3 if sys.version_info[:2] >= (3, 0) else 2
 
 
 def get_channel(channel_url, basic=False, gdata=False,
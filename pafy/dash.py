@@ -0,0 +1,203 @@
+""" DASH segment indexes, used to download time ranges of streams.
+
+A segment index maps media time to the parts of a stream holding it.  For
+single file DASH streams (fragmented mp4) it is read from the sidx box,
+located with the byte ranges given in the DASH manifest or by reading the
+boxes at the start of the file.  Segmented streams (youtube-dl formats
+with a fragment_base_url) list their fragments and durations directly.
+
+"""
+
+import struct
+import logging
+
+from .util import open_url
+from .instrument import measure
+
+dbg = logging.debug
+
+
+class SegmentIndex(object):
+
+    """ Initialization data and media segments of a stream.
+
+    init is a (url, byte range) tuple, segments a list of (start time,
+    end time, url, byte range) tuples, byte ranges being (first, last)
+    tuples or None for whole urls.
+
+    """
+
+    def __init__(self, init, segments):
+        self.init = init
+        self.segments = segments
+
+    def select(self, start, end):
+        """ Return the segments overlapping start to end seconds. """
+        return [s for s in self.segments if s[1] > start and s[0] < end]
+
+    def parts(self, start, end):
+        """ Return (url, byte range) parts to fetch for start to end.
+
+        Adjacent byte ranges of the same url are merged so each part is
+        fetched with one request.
+
+        """
+        parts = [self.init]
+
+        for _, _, url, brange in self.select(start, end):
+            last_url, last_range = parts[-1]
+
+            if (brange and last_range and url == last_url and
+                    brange[0] == last_range[1] + 1):
+                parts[-1] = url, (last_range[0], brange[1])
+
+            else:
+                parts.append((url, brange))
+
+        return parts
+
+
+def fetch_range(url, first, last):
+    """ Return bytes first to last (inclusive) of url. """
+    with measure("index", url) as event:
+        response = open_url(url, {"Range": "bytes=%d-%d" % (first, last)})
+        event.status = response.getcode()
+
+        try:
+            if response.getcode() != 206:
+                raise IOError("Range requests not supported for %s" % url)
+
+            data = response.read()
+
+        finally:
+            response.close()
+
+        event.bytes = len(data)
+
+    return data
+
+
+def _box_header(data, pos):
+    """ Return (type, size, header length) of the box at pos in data. """
+    size, kind = struct.unpack(">I4s", data[pos:pos + 8])
+
+    if size == 1:
+        size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+        return kind, size, 16
+
+    return kind, size, 8
+
+
+def parse_sidx(data, url, offset):
+    """ Return segments of the sidx box data found at byte offset of url. """
+    size = _box_header(data, 0)[1]
+    version = struct.unpack(">B", data[8:9])[0]
+    pos = 12
+    timescale = struct.unpack(">I", data[pos + 4:pos + 8])[0]
+    pos += 8
+
+    if version == 0:
+        earliest, first_offset = struct.unpack(">II", data[pos:pos + 8])
+        pos += 8
+
+    else:
+        earliest, first_offset = struct.unpack(">QQ", data[pos:pos + 16])
+        pos += 16
+
+    count = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+    pos += 4
+    byte, t = offset + size + first_offset, earliest
+    segments = []
+
+    for _ in range(count):
+        ref, duration = struct.unpack(">II", data[pos:pos + 8])
+        pos += 12
+
+        if ref >> 31:
+            raise ValueError("Hierarchical segment indexes are not supported")
+
+        ref_size = ref & 0x7fffffff
+        segments.append((float(t) / timescale,
+                         float(t + duration) / timescale,
+                         url, (byte, byte + ref_size - 1)))
+        t += duration
+        byte += ref_size
+
+    return segments
+
+
+def mp4_index(url, init_range=None, index_range=None, probe=65536):
+    """ Return SegmentIndex of a fragmented mp4 stream at url.
+
+    init_range and index_range are the (first, last) byte ranges of the
+    initialization data and sidx box if known (from a DASH manifest),
+    otherwise the boxes at the start of the file are read to find them.
+    Raises ValueError if the stream has no segment index.
+
+    """
+    if init_range and index_range:
+        first = min(init_range[0], index_range[0])
+        data = fetch_range(url, first, max(init_range[1], index_range[1]))
+        sidx = data[index_range[0] - first:index_range[1] - first + 1]
+
+        if sidx[4:8] != b"sidx":
+            raise ValueError("No segment index at %d-%d" % index_range)
+
+        return SegmentIndex((url, init_range),
+                            parse_sidx(sidx, url, index_range[0]))
+
+    data = fetch_range(url, 0, probe - 1)
+
+    if data[4:8] != b"ftyp":
+        raise ValueError("Not an mp4 stream, no segment index")
+
+    pos, init_end = 0, None
+
+    while True:
+        if pos + 8 > len(data):
+            data += fetch_range(url, len(data), pos + probe)
+
+        kind, size, _ = _box_header(data, pos)
+
+        if kind == b"sidx":
+            if pos + size > len(data):
+                data += fetch_range(url, len(data), pos + size - 1)
+
+            if init_end is None:
+                raise ValueError("No initialization data before sidx")
+
+            return SegmentIndex((url, (0, init_end)),
+                                parse_sidx(data[pos:pos + size], url, pos))
+
+        if kind in (b"moof", b"mdat") or size < 8:
+            raise ValueError("Stream has no segment index")
+
+        if kind == b"moov":
+            init_end = pos + size - 1
+
+        dbg("skipping %s box of %d bytes", kind, size)
+        pos += size
+
+
+def fragment_index(base_url, fragments):
+    """ Return SegmentIndex from a list of (path, duration) fragments.
+
+    A fragment without duration is the initialization segment.
+
+    """
+    init, segments, t = None, [], 0.0
+
+    for path, duration in fragments:
+        url = path if "://" in path else base_url + path
+
+        if duration is None:
+            init = url, None
+            continue
+
+        segments.append((t, t + duration, url, None))
+        t += duration
+
+    if init is None:
+        raise ValueError("Stream has no initialization segment")
+
+    return SegmentIndex(init, segments)
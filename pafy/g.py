@@ -15,6 +15,7 @@ urls = {
     'thumb': "http://i.ytimg.com/vi/%s/default.jpg",
     'bigthumb': "http://i.ytimg.com/vi/%s/mqdefault.jpg",
     'bigthumbhd': "http://i.ytimg.com/vi/%s/hqdefault.jpg",
+    'thumbdir': "http://i.ytimg.com/vi/%s/",
 
     # For internal backend
     'vidinfo': ('https://www.youtube.com/get_video_info?video_id=%s&'
@@ -26,8 +27,52 @@ user_agent = "pafy " + __version__
 lifespan = 60 * 60 * 5  # 5 hours
 opener = build_opener()
 opener.addheaders = [('User-Agent', user_agent)]
+accept_encoding = "gzip, deflate"  # for page and api requests, None disables
 cache = {}
 def_ydl_opts = {'quiet': True, 'prefer_insecure': False, 'no_warnings': True}
+# Keep youtube-dl's full info dicts (Pafy._ydl_info, Stream._info), which
+# are otherwise reduced to the fields pafy uses to save memory
+keep_ydl_info = False
+# Merged into the ydl options of videos created with flat=True
+flat_ydl_opts = {'extract_flat': 'in_playlist',
+                 'youtube_include_dash_manifest': False}
+
+# Gdata quota accounting and rate limiting, see util.GdataGovernor
+# Cost in quota units per api endpoint, endpoints not listed cost 1 unit
+gdata_costs = {
+    'search': 100,
+    'videos': 1,
+    'videoCategories': 1,
+    'playlists': 1,
+    'playlistItems': 1,
+    'channels': 1,
+    'subscriptions': 1,
+}
+gdata_rate = 5.0  # requests per second
+gdata_burst = 10  # requests allowed back to back before rate limiting
+gdata_quota = None  # quota units allowed per period, None for no limit
+gdata_quota_period = 60 * 60 * 24
+
+# Downloads are written to disk by a background thread, see util.WriteBehind
+write_buffer = 16 * 1024 * 1024  # bytes buffered before downloads wait
+# reserve the file size up front (posix_fallocate).  Partial downloads are
+# resumed from their file size, so a preallocated file left by a process
+# that was killed is downloaded again from the start
+preallocate = False
+# fsync policy: None never, "close" once complete, an int every n bytes
+download_fsync = None
+
+# Downloads reconnect when their throughput stays below throttle_factor times
+# the stream's playback rate for throttle_window seconds, at most
+# throttle_reconnects times per download.  See util.ThroughputMonitor
+throttle_factor = 2.0  # None disables
+throttle_window = 5.0
+throttle_reconnects = 10
+
+# Best thumbnails found by getbestthumb are cached per video id
+thumb_cache_size = 1000
+thumb_workers = 8  # concurrent thumbnail requests
+thumb_dir = None  # fetch_thumbs cache, None for ~/.cache/pafy/thumbs
 
 # The following are specific to the internal backend
 UEFSM = 'url_encoded_fmt_stream_map'
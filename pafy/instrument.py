@@ -0,0 +1,264 @@
+""" Instrumentation of network calls.
+
+Functions registered with add_hook() are called with an Event for every
+network call pafy makes: page and api fetches, cached script lookups and
+downloads.  PhaseStats is a hook aggregating events into per-phase counters
+and latency histograms.
+
+    stats = pafy.PhaseStats()
+    pafy.add_hook(stats)
+    ...
+    print(stats.report())
+
+The time spent in each phase while a video is resolved, including steps
+that are not network calls (eg. decoding signatures), is also collected
+per video into Pafy.timings.
+
+"""
+
+import sys
+import time
+import bisect
+import logging
+import threading
+
+if sys.version_info[:2] >= (3, 0):
+    # pylint: disable=E0611,F0401,I0011
+    from urllib.parse import urlparse
+
+else:
+    from urlparse import urlparse
+
+dbg = logging.debug
+_hooks = []
+_local = threading.local()
+
+
+class Event(object):
+
+    """ A network call.
+
+    phase names the call, eg. embed, vidinfo, watchpage, js, dash, gdata,
+    playlist, download, index (reading a DASH segment index) or thumb.
+    status is the HTTP status (None if unknown or no response was
+    received), error the exception raised if the call failed and cache_hit
+    is True if it was answered from a local cache.  bytes is the size of
+    the data received, duration in seconds.
+
+    """
+
+    def __init__(self, phase, url=None):
+        self.phase = phase
+        self.host = urlparse(url).netloc if url else None
+        self.bytes = 0
+        self.duration = 0.0
+        self.status = None
+        self.error = None
+        self.cache_hit = False
+
+    def __repr__(self):
+        return ("Event(%r, host=%r, bytes=%d, duration=%.3f, status=%r%s)" %
+                (self.phase, self.host, self.bytes, self.duration,
+                 self.status, ", cache_hit=True" if self.cache_hit else ""))
+
+
+def add_hook(hook):
+    """ Call hook(event) for every network call. """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    """ Stop calling hook. """
+    _hooks.remove(hook)
+
+
+def emit(event):
+    """ Pass event to the hooks.  Errors raised by hooks are logged. """
+    for hook in list(_hooks):
+        try:
+            hook(event)
+
+        except Exception as e:  # pylint: disable=W0703
+            dbg("instrumentation hook %r failed: %r", hook, e)
+
+
+class measure(object):
+
+    """ Context manager timing a network call, emitting its Event on exit.
+
+        with measure("dash", url) as event:
+            response = open_url(url)
+            event.status = response.getcode()
+            ...
+
+    """
+
+    def __init__(self, phase, url=None):
+        self.event = Event(phase, url)
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+        return self.event
+
+    def __exit__(self, etype, value, tb):
+        self.event.duration = time.time() - self._start
+
+        if value is not None:
+            self.event.error = value
+            self.event.status = getattr(value, "code", self.event.status)
+
+        record(self.event.phase, self.event.duration)
+        emit(self.event)
+
+
+def record(phase, duration, timings=None):
+    """ Add duration to phase in timings or the timings being collected
+    in this thread. """
+    if timings is None:
+        timings = getattr(_local, "timings", None)
+
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + duration
+
+
+class timed(object):
+
+    """ Context manager timing a step of phase, that is not a network call.
+
+    The duration is added to timings, by default the timings being
+    collected in this thread.  No Event is emitted.
+
+    """
+
+    def __init__(self, phase, timings=None):
+        self.phase = phase
+        self.timings = timings
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.time()
+
+    def __exit__(self, etype, value, tb):
+        record(self.phase, time.time() - self._start, self.timings)
+
+
+class collect(object):
+
+    """ Context manager collecting the phase durations in this thread into
+    timings (a dict), replacing its contents.  The total duration is
+    added as "total" if total is True. """
+
+    def __init__(self, timings, total=True):
+        self.timings = timings
+        self.total = total
+        self._start = self._outer = None
+
+    def __enter__(self):
+        self.timings.clear()
+        self._outer = getattr(_local, "timings", None)
+        _local.timings = self.timings
+        self._start = time.time()
+        return self.timings
+
+    def __exit__(self, etype, value, tb):
+        if self.total:
+            self.timings["total"] = time.time() - self._start
+
+        _local.timings = self._outer
+
+
+class PhaseStats(object):
+
+    """ Hook aggregating events per phase.
+
+    Call durations are counted in histogram buckets with the upper bounds
+    in BUCKETS (seconds), the last bucket holding longer calls.
+
+    """
+
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._phases = {}
+
+    def __call__(self, event):
+        """ Record event. """
+        with self._lock:
+            phase = self._phases.get(event.phase)
+
+            if phase is None:
+                phase = self._phases[event.phase] = dict(
+                    count=0, errors=0, cache_hits=0, bytes=0, time=0.0,
+                    histogram=[0] * (len(self.BUCKETS) + 1))
+
+            phase['count'] += 1
+            phase['errors'] += event.error is not None
+            phase['cache_hits'] += event.cache_hit
+            phase['bytes'] += event.bytes
+            phase['time'] += event.duration
+            bucket = bisect.bisect_left(self.BUCKETS, event.duration)
+            phase['histogram'][bucket] += 1
+
+    def add_timings(self, timings):
+        """ Record each phase of a Pafy.timings dict, for a report across
+        many videos. """
+        for phase, duration in timings.items():
+            event = Event(phase)
+            event.duration = duration
+            self(event)
+
+    def stats(self):
+        """ Return dict of phase: counters, histogram and mean duration. """
+        with self._lock:
+            result = {}
+
+            for name, phase in self._phases.items():
+                phase = dict(phase, histogram=list(phase['histogram']))
+                phase['mean'] = phase['time'] / phase['count']
+                result[name] = phase
+
+            return result
+
+    def percentile(self, phase, q):
+        """ Return upper bound of the bucket holding the q-th percentile of
+        phase durations, None if it is in the last (unbounded) bucket. """
+        histogram = self.stats()[phase]['histogram']
+        rank = q / 100.0 * sum(histogram)
+        seen = 0
+
+        for bound, count in zip(self.BUCKETS, histogram):
+            seen += count
+
+            if count and seen >= rank:
+                return bound
+
+        return None
+
+    def report(self):
+        """ Return a table of the phases as a string. """
+        stats = self.stats()
+        lines = ["%-10s %6s %6s %6s %12s %9s %7s %7s" %
+                 ("phase", "calls", "errors", "cached", "bytes", "mean ms",
+                  "p50 ms", "p95 ms")]
+
+        def ms(bound):
+            """ Format a bucket bound in ms. """
+            if bound is None:
+                return ">%d" % (self.BUCKETS[-1] * 1000)
+
+            return "%d" % (bound * 1000)
+
+        for name in sorted(stats, key=lambda n: -stats[n]['time']):
+            phase = stats[name]
+            lines.append("%-10s %6d %6d %6d %12d %9.1f %7s %7s" % (
+                name, phase['count'], phase['errors'], phase['cache_hits'],
+                phase['bytes'], phase['mean'] * 1000,
+                ms(self.percentile(name, 50)), ms(self.percentile(name, 95))))
+
+        return "\n".join(lines)
@@ -29,25 +29,36 @@ import logging
 import time
 import re
 
-if sys.version_info[:2] >= (3, 0):
-    # pylint: disable=E0611,F0401,I0011
-    from urllib.error import HTTPError
-
-else:
-    from urllib2 import HTTPError
-
 from . import g
-from .util import call_gdata
+from . import util
+from .util import call_gdata, open_url, read_response
+from .instrument import measure
 
 Pafy = None
 
-# Select which backend to use
+
+def _module_available(name):
+    """ Return True if module name can be imported, without importing it. """
+    try:
+        from importlib.util import find_spec
+    except ImportError:  # Python 2
+        import imp
+        try:
+            imp.find_module(name)
+        except ImportError:
+            return False
+        return True
+
+    return find_spec(name) is not None
+
+
+# Select which backend to use. The backend module, and youtube-dl with it,
+# is only imported by the first call to new()
 backend = "internal"
 if os.environ.get("PAFY_BACKEND") != "internal":
-    try:
-        import youtube_dl
+    if _module_available("youtube_dl"):
         backend = "youtube-dl"
-    except ImportError:
+    else:
         raise ImportError(
                "pafy: youtube-dl not found; you can use the internal backend by "
                "setting the environmental variable PAFY_BACKEND to \"internal\". "
@@ -61,34 +72,41 @@ if os.environ.get("pafydebug") == "1":
 dbg = logging.debug
 
 
-def fetch_decode(url, encoding=None):
-    """ Fetch url and decode. """
-    try:
-        req = g.opener.open(url)
-    except HTTPError as e:
-        if e.getcode() == 503:
-            time.sleep(.5)
-            return fetch_decode(url, encoding)
-        else:
-            raise
-
-    ct = req.headers['content-type']
+def fetch_decode(url, encoding=None, phase="fetch"):
+    """ Fetch url and decode.  phase names the call for instrumentation. """
+    with measure(phase, url) as event:
+        req = open_url(url, compressed=True)
+        event.status = req.getcode()
+        ct = req.headers['content-type']
+        data = read_response(req)
+        event.bytes = len(data)
 
     if encoding:
-        return req.read().decode(encoding)
+        return data.decode(encoding)
 
     elif "charset=" in ct:
         dbg("charset: %s", ct)
         encoding = re.search(r"charset=([\w-]+)\s*(:?;|$)", ct).group(1)
-        return req.read().decode(encoding)
+        return data.decode(encoding)
 
     else:
         dbg("encoding unknown")
-        return req.read()
+        return data
+
+
+def fetch_json(url, phase="fetch"):
+    """ Fetch url and decode the json response from bytes. """
+    with measure(phase, url) as event:
+        req = open_url(url, compressed=True)
+        event.status = req.getcode()
+        data = read_response(req)
+        event.bytes = len(data)
+
+    return util.json_loads(data)
 
 
 def new(url, basic=True, gdata=False, size=False,
-        callback=None, ydl_opts=None):
+        callback=None, ydl_opts=None, flat=False):
     """ Return a new pafy instance given a url or video id.
 
     NOTE: The signature argument has been deprecated and now has no effect,
@@ -99,6 +117,9 @@ def new(url, basic=True, gdata=False, size=False,
         gdata - fetch gdata info (upload date, description, category)
         size - fetch the size of each stream (slow)(decrypts urls if needed)
         callback - a callback function to receive status strings
+        ydl_opts - options passed to youtube-dl (youtube-dl backend only)
+        flat - fetch metadata without processing the formats, which are
+            turned into streams when first used (youtube-dl backend only)
 
     If any of the first three above arguments are False, those data items will
     be fetched only when first called for.
@@ -117,11 +138,12 @@ def new(url, basic=True, gdata=False, size=False,
     global Pafy
     if Pafy is None:
         if backend == "internal":
-           from .backend_internal import InternPafy as Pafy
+            from .backend_internal import InternPafy as Pafy
         else:
-           from .backend_youtube_dl import YtdlPafy as Pafy
+            from .backend_youtube_dl import YtdlPafy as Pafy
 
-    return Pafy(url, basic, gdata, size, callback, ydl_opts=ydl_opts)
+    return Pafy(url, basic, gdata, size, callback, ydl_opts=ydl_opts,
+                flat=flat)
 
 
 def cache(name):
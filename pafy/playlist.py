@@ -1,10 +1,9 @@
 import sys
 import re
-import json
 import itertools
 
 from . import g
-from .pafy import new, get_categoryname, call_gdata, fetch_decode
+from .pafy import new, get_categoryname, call_gdata, fetch_json
 
 
 if sys.version_info[:2] >= (3, 0):
@@ -55,8 +54,7 @@ def get_playlist(playlist_url, basic=False, gdata=False,
 
     url = g.urls["playlist"] % playlist_id
 
-    allinfo = fetch_decode(url)  # unicode
-    allinfo = json.loads(allinfo)
+    allinfo = fetch_json(url, "playlist")
 
     # playlist specific metadata
     playlist = dict(
@@ -0,0 +1,297 @@
+""" Stream selection index and declarative stream selectors.
+
+A selector names the stream to pick with a small expression language
+modelled on youtube-dl's format selection, eg.
+
+    bestvideo[height<=720][ext=webm]+bestaudio/best
+
+Each term is one of best, worst (streams with audio and video), bestvideo,
+worstvideo, bestaudio or worstaudio, optionally followed by [field op value]
+filters.  Two terms joined by + select a (video, audio) pair and
+alternatives separated by / are tried in order until one matches.
+
+"""
+
+import re
+import operator
+
+
+class StreamRanking(object):
+
+    """ Streams ranked once by a (group, value) key.
+
+    group is True for streams that rank higher regardless of value (eg. not
+    3D), value is the quality measure (eg. width or bitrate).  best() and
+    worst() return the same streams as taking max() or min() over the sort
+    keys previously used by getbest() and friends, without sorting again.
+
+    """
+
+    def __init__(self, streams, keyfunc):
+        """ Rank streams, build lookup tables. """
+        keyed = [(keyfunc(s), s) for s in streams]
+        # Sorting is stable in both directions, so among equal keys the
+        # first stream in the original order comes first, as with max/min
+        self.desc = [s for k, s in sorted(keyed, key=operator.itemgetter(0),
+                                          reverse=True)]
+        self.asc = [s for k, s in sorted(keyed, key=operator.itemgetter(0))]
+        self._first = {}
+        self._top_ties = []
+        self._bottom_ties = []
+        self._bottom_exts = set()
+
+        if not keyed:
+            return
+
+        keys = dict((id(s), k) for k, s in keyed)
+        top, bottom = keys[id(self.desc[0])], keys[id(self.asc[0])]
+
+        for s in self.desc:
+            key = keys[id(s)]
+            self._first.setdefault((key[0], s.extension), s)
+
+            if key == top:
+                self._top_ties.append(s)
+
+        for s in self.asc:
+            key = keys[id(s)]
+
+            if key[0] == bottom[0]:
+                self._bottom_exts.add(s.extension)
+
+            if key == bottom:
+                self._bottom_ties.append(s)
+
+        self._top_group = top[0]
+
+    def best(self, preftype="any", ftypestrict=True):
+        """ Return the highest ranked stream, preferring extension preftype.
+
+        With ftypestrict, return None unless the best stream of the highest
+        group has extension preftype.
+
+        """
+        if not self.desc:
+            return None
+
+        if preftype == "any":
+            return self.desc[0]
+
+        if ftypestrict:
+            return self._first.get((self._top_group, preftype))
+
+        for s in self._top_ties:
+            if s.extension == preftype:
+                return s
+
+        return self.desc[0]
+
+    def worst(self, preftype="any", ftypestrict=True):
+        """ Return the lowest ranked stream, see best(). """
+        if not self.asc:
+            return None
+
+        if preftype == "any":
+            return self.asc[0]
+
+        if ftypestrict:
+            if self._bottom_exts - set([preftype]):
+                return None
+
+            return self.asc[0]
+
+        for s in self._bottom_ties:
+            if s.extension != preftype:
+                return s
+
+        return self.asc[0]
+
+
+def _videokey(stream):
+    """ Ranking key for streams with video: 3D last, then by width. """
+    return "3D" not in stream.resolution, int(stream.resolution.split("x")[0])
+
+
+def _audiokey(stream):
+    """ Ranking key for audio streams: by bitrate. """
+    return True, int(stream.rawbitrate or 0)
+
+
+def _int(value):
+    """ Return value as int, 0 if it is not a number. """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def selection_keys(stream):
+    """ Return dict of the fields selector filters may test for stream. """
+    dimensions = stream.dimensions or (0, 0)
+    rawbitrate = _int(stream.rawbitrate)
+    return dict(width=_int(dimensions[0]),
+                height=_int(dimensions[1]),
+                bitrate=rawbitrate,
+                abr=rawbitrate // 1024,
+                ext=stream.extension,
+                itag=str(stream.itag),
+                mediatype=stream.mediatype,
+                threed=bool(stream.threed),
+                codec=(stream.codec or "").lower(),
+                notes=stream.notes or "")
+
+
+class StreamIndex(object):
+
+    """ Per video selection index, built once when streams are processed.
+
+    Holds a StreamRanking for each stream kind and the selection keys of
+    every stream.
+
+    """
+
+    def __init__(self, streams, videostreams, audiostreams):
+        """ Build rankings and compute selection keys. """
+        self.normal = StreamRanking(streams, _videokey)
+        self.video = StreamRanking(videostreams, _videokey)
+        self.audio = StreamRanking(audiostreams, _audiokey)
+        self.keys = {}
+
+        for s in streams + videostreams + audiostreams:
+            self.keys[id(s)] = selection_keys(s)
+
+
+_OPS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '^=': lambda a, b: a.startswith(b),
+    '$=': lambda a, b: a.endswith(b),
+    '*=': lambda a, b: b in a,
+}
+_NUMERIC = ('width', 'height', 'bitrate', 'abr')
+_STRING = ('ext', 'itag', 'mediatype', 'codec', 'notes')
+_BOOL = ('threed',)
+_TERMS = {
+    'best': ('normal', True), 'worst': ('normal', False),
+    'bestvideo': ('video', True), 'worstvideo': ('video', False),
+    'bestaudio': ('audio', True), 'worstaudio': ('audio', False),
+}
+_FILTER_RE = re.compile(r'\[\s*(\w+)\s*(!=|<=|>=|\^=|\$=|\*=|=|<|>)\s*'
+                        r'([^\]]*?)\s*\]')
+_TERM_RE = re.compile(r'\s*(\w+)\s*((?:\[[^\]]*\]\s*)*)$')
+
+
+class _Term(object):
+
+    """ One term of a selector, eg. bestvideo[height<=720]. """
+
+    def __init__(self, text):
+        """ Parse text. """
+        m = _TERM_RE.match(text)
+
+        if not m or m.group(1) not in _TERMS:
+            raise ValueError("Invalid stream selector term: %r" % text)
+
+        self.kind, self.best = _TERMS[m.group(1)]
+        self.filters = []
+        filters = m.group(2)
+
+        for fm in _FILTER_RE.finditer(filters):
+            field, op, value = fm.groups()
+
+            if field == '3d':
+                field = 'threed'
+
+            if field in _NUMERIC:
+                if op not in ('=', '!=', '<', '<=', '>', '>='):
+                    raise ValueError("Invalid operator for %s: %s" %
+                                     (field, op))
+                value = int(value.rstrip('kKpP'))
+
+            elif field in _BOOL:
+                value = value.lower() in ('1', 'true', 'yes')
+
+            elif field in _STRING:
+                value = value.lower() if field == 'codec' else value
+
+            else:
+                raise ValueError("Unknown stream selector field: %s" % field)
+
+            self.filters.append((field, _OPS[op], value))
+
+        if len(_FILTER_RE.sub('', filters).strip()):
+            raise ValueError("Invalid stream selector filter: %r" % filters)
+
+    def evaluate(self, index):
+        """ Return the selected stream from index or None. """
+        ranking = getattr(index, self.kind)
+
+        if not self.filters:
+            return ranking.best() if self.best else ranking.worst()
+
+        for s in ranking.desc if self.best else ranking.asc:
+            keys = index.keys[id(s)]
+
+            if all(op(keys[field], value) for field, op, value in
+                   self.filters):
+                return s
+
+        return None
+
+
+class Selector(object):
+
+    """ A parsed stream selector, reusable across any number of videos. """
+
+    def __init__(self, spec):
+        """ Parse spec, raise ValueError if it is invalid. """
+        self.spec = spec
+        self.alternatives = []
+
+        for alternative in spec.split('/'):
+            terms = [_Term(t) for t in alternative.split('+')]
+
+            if len(terms) > 2:
+                raise ValueError("At most two streams can be merged: %r"
+                                 % alternative)
+
+            self.alternatives.append(terms)
+
+    def evaluate(self, index):
+        """ Return selected stream, (video, audio) tuple or None. """
+        for terms in self.alternatives:
+            selected = [t.evaluate(index) for t in terms]
+
+            if all(selected):
+                return selected[0] if len(selected) == 1 else tuple(selected)
+
+        return None
+
+    def __repr__(self):
+        return "Selector(%r)" % self.spec
+
+
+_selectors = {}
+_MAX_SELECTORS = 100
+
+
+def get_selector(spec):
+    """ Return the Selector for spec, parsing each distinct spec once.
+
+    Up to _MAX_SELECTORS selectors are kept, the cache is emptied when it
+    is full (as the re module does with compiled patterns).
+
+    """
+    selector = _selectors.get(spec)
+
+    if selector is None:
+        if len(_selectors) >= _MAX_SELECTORS:
+            _selectors.clear()
+
+        selector = _selectors[spec] = Selector(spec)
+
+    return selector
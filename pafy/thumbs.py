@@ -0,0 +1,304 @@
+""" Thumbnail resolution and fetching.
+
+YouTube serves thumbnails of several sizes for each video, not all of which
+exist for every video.  The best available one is found by probing the
+candidates with HEAD requests, concurrently, and remembered per video id.
+
+Thumbnails are fetched in bulk into an on-disk cache, stored by the sha256
+of their content and revalidated with conditional requests.
+
+"""
+
+import os
+import sys
+import json
+import hashlib
+import tempfile
+import threading
+from collections import deque
+
+if sys.version_info[:2] >= (3, 0):
+    # pylint: disable=E0611,F0401,I0011
+    from urllib.error import HTTPError
+
+else:
+    from urllib2 import HTTPError
+
+from . import g
+from .util import open_url, parallel_map
+from .instrument import measure
+
+# Thumbnail names, best first
+THUMBS = ("maxresdefault.jpg",
+          "sddefault.jpg",
+          "hqdefault.jpg",
+          "mqdefault.jpg",
+          "default.jpg")
+
+
+class BoundedCache(object):
+
+    """ Thread safe mapping keeping the maxsize most recently used items.
+
+    If maxsize is None, g.thumb_cache_size is used, read as items are added.
+
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize
+        self._items = {}
+        self._lru = deque()  # keys, least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+
+            self._lru.remove(key)
+            self._lru.append(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self._lru.remove(key)
+
+            self._items[key] = value
+            self._lru.append(key)
+            maxsize = self.maxsize
+
+            if maxsize is None:
+                maxsize = g.thumb_cache_size
+
+            while len(self._items) > maxsize:
+                del self._items[self._lru.popleft()]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._lru.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+bestthumb_cache = BoundedCache()
+
+
+def _available(url):
+    """ Return True if url exists, checked with a HEAD request. """
+    with measure("thumb", url) as event:
+        try:
+            response = open_url(url, method="HEAD")
+
+        except HTTPError as e:
+            event.status = e.getcode()
+            return False
+
+        response.close()
+        event.status = response.getcode()
+
+    return response.getcode() < 300
+
+
+def get_bestthumbs(videoids, workers=None):
+    """ Return dict of video id: best available thumbnail url.
+
+    The thumbnails of all video ids not already cached are probed
+    concurrently, by up to workers (default g.thumb_workers) threads.
+    Video ids without any thumbnail map to None.
+
+    """
+    found, probes = {}, []
+
+    for videoid in videoids:
+        found[videoid] = bestthumb_cache.get(videoid)
+
+        if not found[videoid]:
+            probes.extend(g.urls['thumbdir'] % videoid + thumb
+                          for thumb in THUMBS)
+
+    results = dict(zip(probes, parallel_map(_available, probes,
+                                            workers or g.thumb_workers)))
+
+    for videoid in found:
+        if found[videoid]:
+            continue
+
+        for thumb in THUMBS:
+            url = g.urls['thumbdir'] % videoid + thumb
+
+            if results[url]:
+                found[videoid] = url
+                bestthumb_cache.set(videoid, url)
+                break
+
+    return found
+
+
+def get_bestthumb(videoid):
+    """ Return the best available thumbnail url of videoid or None. """
+    return get_bestthumbs([videoid], workers=len(THUMBS))[videoid]
+
+
+def _default_dir():
+    """ Return the default thumbnail cache directory. """
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pafy", "thumbs")
+
+
+class ThumbStore(object):
+
+    """ Content addressed thumbnail cache in directory path.
+
+    Images are stored as path/ab/abcdef..., named by the sha256 of their
+    data, so a thumbnail served under several urls is stored once.
+    index.json maps each url to its digest and the ETag and Last-Modified
+    headers used to revalidate it.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or g.thumb_dir or _default_dir()
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(self.path, "index.json")
+
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+        try:
+            with open(self._index_path) as f:
+                self.index = json.load(f)
+
+        except (IOError, ValueError):
+            self.index = {}
+
+    def blob_path(self, digest):
+        """ Return the path of the image with sha256 hex digest. """
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _write_blob(self, data):
+        """ Store data, return its digest. """
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+
+        if os.path.exists(path):
+            return digest
+
+        dirname = os.path.dirname(path)
+
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+
+            except OSError:  # created by another thread meanwhile
+                pass
+
+        fd, temp = tempfile.mkstemp(dir=dirname)
+
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+
+        os.rename(temp, path)
+        return digest
+
+    def fetch(self, url):
+        """ Return the cached path of url, fetching or revalidating it.
+
+        Returns None if the server has no image at url.
+
+        """
+        with self._lock:
+            entry = self.index.get(url)
+
+        headers = {}
+
+        if entry and os.path.exists(self.blob_path(entry['sha256'])):
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+
+            if entry.get('modified'):
+                headers['If-Modified-Since'] = entry['modified']
+
+        with measure("thumb", url) as event:
+            try:
+                response = open_url(url, headers)
+
+            except HTTPError as e:
+                if e.getcode() == 304 and headers:
+                    event.status, event.cache_hit = 304, True
+                    return self.blob_path(entry['sha256'])
+
+                if e.getcode() == 404:
+                    event.status = 404
+                    return None
+
+                raise
+
+            try:
+                event.status = response.getcode()
+                data = response.read()
+                info = response.info()
+
+            finally:
+                response.close()
+
+            event.bytes = len(data)
+
+        entry = dict(sha256=self._write_blob(data),
+                     etag=info.get('ETag'),
+                     modified=info.get('Last-Modified'))
+
+        with self._lock:
+            self.index[url] = entry
+
+        return self.blob_path(entry['sha256'])
+
+    def save(self):
+        """ Write the index to disk. """
+        with self._lock:
+            fd, temp = tempfile.mkstemp(dir=self.path)
+
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.index, f)
+
+        # os.rename does not replace existing files on Windows
+        getattr(os, "replace", os.rename)(temp, self._index_path)
+
+
+def fetch_thumbs(urls, path=None, workers=None, data=False):
+    """ Fetch thumbnail urls into the cache at path (default g.thumb_dir).
+
+    Each distinct url is fetched once, by up to workers (default
+    g.thumb_workers) threads.  Cached thumbnails are revalidated with
+    If-None-Match / If-Modified-Since requests and only downloaded again
+    if they changed.  Returns dict of url: local file path, or the image
+    data if data is True.  Urls with no image map to None.
+
+    """
+    unique, seen = [], set()
+
+    for url in urls:
+        if url not in seen:
+            seen.add(url)
+            unique.append(url)
+
+    store = ThumbStore(path)
+
+    try:
+        paths = parallel_map(store.fetch, unique, workers or g.thumb_workers)
+
+    finally:
+        store.save()
+
+    found = dict(zip(unique, paths))
+
+    if data:
+        for url, local in found.items():
+            if local:
+                with open(local, "rb") as f:
+                    found[url] = f.read()
+
+    return found
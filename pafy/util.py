@@ -1,18 +1,33 @@
 import json
+import hashlib
+import logging
 import sys
 import os
+import time
+import random
+import socket
+import threading
+import zlib
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
 
 if sys.version_info[:2] >= (3, 0):
     # pylint: disable=E0611,F0401,I0011
-    from urllib.error import HTTPError
-    from urllib.parse import urlencode
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlencode, urlparse
+    from urllib.request import Request
+    from http.client import HTTPException
 
 else:
-    from urllib2 import HTTPError
+    from urllib2 import HTTPError, URLError, Request
     from urllib import urlencode
+    from urlparse import urlparse
+    from httplib import HTTPException
 
 from . import g
+from .instrument import measure, collect, record
 
+dbg = logging.debug
 
 mswin = os.name == "nt"
 not_utf8_environment = mswin or (sys.stdout.encoding and
@@ -24,24 +39,824 @@ class GdataError(Exception):
     pass
 
 
+def _stdlib_json_loads(data):
+    """ Decode json from bytes or text with the standard library. """
+    if isinstance(data, bytes) and sys.version_info[:2] < (3, 6):
+        data = data.decode('utf-8')
+
+    return json.loads(data)
+
+
+# Decoders tried in order by set_json_backend(), all accept utf-8 bytes
+_json_backends = [('orjson', 'loads'), ('ujson', 'loads'),
+                  ('simplejson', 'loads'), ('json', None)]
+json_backend = None
+_json_loads = None
+
+
+def json_loads(data):
+    """ Decode json from bytes or text with the selected json backend. """
+    if _json_loads is None:
+        set_json_backend()
+
+    return _json_loads(data)
+
+
+def set_json_backend(backend=None):
+    """ Set the json decoder used for api and playlist responses.
+
+    backend may be the module name of a supported decoder ('orjson',
+    'ujson', 'simplejson' or 'json'), a callable taking bytes or text, or
+    None to use the fastest decoder installed.  Returns the backend name.
+
+    """
+    global json_backend, _json_loads
+
+    if callable(backend):
+        json_backend = getattr(backend, '__name__', 'custom')
+        _json_loads = backend
+        return json_backend
+
+    for name, funcname in _json_backends:
+        if backend is not None and name != backend:
+            continue
+
+        if funcname is None:
+            json_backend, _json_loads = name, _stdlib_json_loads
+            return json_backend
+
+        try:
+            module = __import__(name)
+        except ImportError:
+            if backend is not None:
+                raise
+            continue
+
+        json_backend, _json_loads = name, getattr(module, funcname)
+        return json_backend
+
+    raise ValueError("Unknown json backend: %s" % backend)
+
+
+class CircuitOpenError(IOError):
+    """Requests to a host are suspended after repeated failures."""
+    pass
+
+
+class RetryPolicy(object):
+
+    """ Bounded retries with exponential backoff and a per host circuit
+    breaker.
+
+    A failed attempt is retried up to attempts - 1 times.  The delay before
+    retry n is drawn uniformly from [0, backoff * 2 ** n] (capped at
+    max_backoff) unless the server sent a Retry-After header, which is then
+    honored, or the error has a true throttled attribute: the caller then
+    already holds back the next attempt itself.  After breaker_threshold
+    consecutive calls to a host failed (all their attempts), requests to
+    it fail immediately with CircuitOpenError for breaker_timeout seconds.
+
+    The breaker state is kept per host and shared by everything calling
+    through the same policy, pass another RetryPolicy to open_url() to
+    keep a caller apart.
+
+    """
+
+    retry_codes = (429, 500, 502, 503, 504)
+
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30.0,
+                 breaker_threshold=5, breaker_timeout=30.0):
+        """ Set initial values. """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self._lock = threading.Lock()
+        self._hosts = {}  # host: [consecutive failed calls, open until]
+
+    def retryable(self, error):
+        """ Return True if error is worth retrying. """
+        if isinstance(error, HTTPError):
+            return error.getcode() in self.retry_codes
+
+        return isinstance(error, (URLError, HTTPException, socket.error))
+
+    def delay(self, attempt, error=None):
+        """ Return seconds to wait before retrying attempt (0 based). """
+        retry_after = _retry_after(error)
+
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** attempt))
+
+    def _check(self, host):
+        """ Raise CircuitOpenError if requests to host are suspended. """
+        with self._lock:
+            failures, open_until = self._hosts.get(host, (0, 0))
+
+        if open_until > time.time():
+            raise CircuitOpenError("Circuit open for %s after %d failures" %
+                                   (host, failures))
+
+    def _record(self, host, failed):
+        """ Record the outcome of a call to host. """
+        with self._lock:
+            if not failed:
+                self._hosts.pop(host, None)
+                return
+
+            failures, open_until = self._hosts.get(host, (0, 0))
+            failures += 1
+
+            if failures >= self.breaker_threshold:
+                open_until = time.time() + self.breaker_timeout
+                dbg("Opening circuit for %s", host)
+
+            self._hosts[host] = [failures, open_until]
+
+    def call(self, func, url, retryable=None):
+        """ Return func(), retrying failed requests to url's host. """
+        host = urlparse(url).netloc
+        retryable = retryable or self.retryable
+        attempt = 0
+
+        while True:
+            self._check(host)
+
+            try:
+                result = func()
+
+            except Exception as e:
+                if not retryable(e):
+                    self._record(host, False)
+                    raise
+
+                attempt += 1
+
+                if attempt >= self.attempts:
+                    self._record(host, True)
+                    raise
+
+                if getattr(e, 'throttled', False):
+                    dbg("%s, retrying %s when the caller allows", e, host)
+                    continue
+
+                delay = self.delay(attempt - 1, e)
+                dbg("%s, retrying %s in %.2fs", e, host, delay)
+                time.sleep(delay)
+
+            else:
+                self._record(host, False)
+                return result
+
+
+retry_policy = RetryPolicy()
+
+
+def _retry_after(error):
+    """ Return the Retry-After value of an HTTPError in seconds or None. """
+    headers = getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+
+    if not value:
+        return None
+
+    if value.strip().isdigit():
+        return int(value)
+
+    date = parsedate_tz(value)
+    return max(mktime_tz(date) - time.time(), 0) if date else None
+
+
+def build_request(url, headers=None, compressed=False, method=None):
+    """ Return a Request for url.
+
+    Set compressed=True to accept a compressed response body, which must
+    then be read with read_response().  method overrides the HTTP method,
+    eg. "HEAD".
+
+    """
+    headers = dict(headers or {})
+
+    if compressed and g.accept_encoding:
+        headers['Accept-Encoding'] = g.accept_encoding
+
+    request = Request(url, headers=headers)
+
+    if method:
+        request.get_method = lambda: method
+
+    return request
+
+
+def open_url(url, headers=None, policy=None, compressed=False, method=None):
+    """ Open url with g.opener under the retry policy.  Return response. """
+    policy = policy or retry_policy
+    request = build_request(url, headers, compressed, method)
+    return policy.call(lambda: g.opener.open(request), url)
+
+
+def parallel_map(func, items, workers):
+    """ Return [func(item) for item in items], run by up to workers threads.
+
+    The first exception raised by func is raised once all threads finish.
+
+    """
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    todo = deque(enumerate(items))
+
+    def work():
+        while True:
+            try:
+                n, item = todo.popleft()
+            except IndexError:
+                return
+
+            try:
+                results[n] = func(item)
+            except Exception as e:  # pylint: disable=W0703
+                errors.append((n, e))
+
+    threads = [threading.Thread(target=work)
+               for _ in range(min(workers, len(items)))]
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise min(errors, key=lambda error: error[0])[1]
+
+    return results
+
+
+class Background(object):
+
+    """ Call func(*args) in a thread.
+
+    result() waits for the call to finish and returns its value, or raises
+    its exception.  Phase timings recorded by the call are added to those
+    being collected in the thread calling result().
+
+    """
+
+    def __init__(self, func, *args):
+        self._value = self._error = None
+        self._timings = {}
+        self._thread = threading.Thread(target=self._run, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        with collect(self._timings, total=False):
+            try:
+                self._value = func(*args)
+
+            except Exception as e:  # pylint: disable=W0703
+                self._error = e
+
+    def result(self):
+        """ Return the value returned by the call. """
+        self._thread.join()
+
+        for phase, duration in self._timings.items():
+            record(phase, duration)
+
+        self._timings = {}
+
+        if self._error:
+            raise self._error
+
+        return self._value
+
+
+class Hashes(object):
+
+    """ Incremental hashes of data, eg. Hashes(("sha256", "md5")).
+
+    Names are those accepted by hashlib.new().
+
+    """
+
+    def __init__(self, names):
+        """ Create a hash object for each name. """
+        if hasattr(names, "lower"):
+            names = (names,)
+
+        self._hashes = [(name, hashlib.new(name)) for name in names]
+
+    def update(self, data):
+        for _, h in self._hashes:
+            h.update(data)
+
+    def hexdigests(self):
+        """ Return dict of name: hex digest of the data so far. """
+        return dict((name, h.hexdigest()) for name, h in self._hashes)
+
+
+def _preallocate(fh, offset, length):
+    """ Reserve length bytes of fh from offset.  Return True on success. """
+    fallocate = getattr(os, "posix_fallocate", None)
+
+    if not fallocate:
+        return False
+
+    try:
+        fallocate(fh.fileno(), offset, length)
+
+    except OSError as e:
+        dbg("Preallocation of %s failed: %s", fh.name, e)
+        return False
+
+    return True
+
+
+class WriteBehind(object):
+
+    """ Binary file writer doing the actual writes on a background thread.
+
+    write() queues data and returns at once unless more than buffer_size
+    bytes are waiting, so a slow disk does not stall the network reads.
+    The file is preallocated to size bytes if given and g.preallocate is
+    set, and truncated to the data written on close, also after errors.
+    fsync is None (never), "close" or a number of bytes between syncs,
+    g.download_fsync by default.  Errors on the writer thread are raised
+    by the next write() or close().
+
+    Data written is added to hashes (a Hashes object) if given, including
+    the existing contents of a file opened for appending.
+
+    """
+
+    def __init__(self, path, mode="wb", size=None, buffer_size=None,
+                 fsync=None, hashes=None):
+        """ Open path for writing, appending if mode contains 'a'. """
+        if "a" in mode and os.path.exists(path):
+            if hashes:
+                with open(path, "rb") as fh:
+                    for chunk in iter(lambda: fh.read(65536), b""):
+                        hashes.update(chunk)
+
+            # not opened in append mode, which would write after the
+            # preallocated space
+            self._fh = open(path, "r+b")
+            self._fh.seek(0, os.SEEK_END)
+
+        else:
+            self._fh = open(path, "wb")
+
+        self.name = path
+        self.closed = False
+        self._pos = self._written = self._fh.tell()
+        self._preallocated = bool(size and g.preallocate and
+                                  size > self._pos and
+                                  _preallocate(self._fh, self._pos,
+                                               size - self._pos))
+        self._buffer_size = buffer_size or g.write_buffer
+        self._fsync = g.download_fsync if fsync is None else fsync
+        self._hashes = hashes
+        self._chunks = deque()
+        self._buffered = 0
+        self._unsynced = 0
+        self._done = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        """ Write queued chunks until closed. """
+        while True:
+            with self._cond:
+                while not self._chunks and not self._done:
+                    self._cond.wait()
+
+                if not self._chunks:
+                    return
+
+                chunk = self._chunks.popleft()
+
+            try:
+                self._fh.write(chunk)
+                self._written += len(chunk)
+                self._unsynced += len(chunk)
+
+                if self._hashes:
+                    self._hashes.update(chunk)
+
+                if self._fsync not in (None, False, "close") and \
+                        self._unsynced >= self._fsync:
+                    self._sync()
+
+            except (IOError, OSError) as e:
+                with self._cond:
+                    self._error = e
+                    self._chunks.clear()
+                    self._buffered = 0
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._buffered -= len(chunk)
+                self._cond.notify_all()
+
+    def _sync(self):
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._unsynced = 0
+
+    def _check(self):
+        if self._error:
+            raise self._error
+
+    def write(self, data):
+        """ Queue data for writing, waiting while the buffer is full. """
+        if not data:
+            return 0
+
+        with self._cond:
+            while (self._buffered and not self._error and
+                   self._buffered + len(data) > self._buffer_size):
+                self._cond.wait()
+
+            self._check()
+            self._chunks.append(data)
+            self._buffered += len(data)
+            self._pos += len(data)
+            self._cond.notify_all()
+
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        """ Wait until all queued data is written. """
+        with self._cond:
+            while self._buffered and not self._error:
+                self._cond.wait()
+
+            self._check()
+
+        self._fh.flush()
+
+    def close(self):
+        """ Write out queued data and close the file. """
+        if self.closed:
+            return
+
+        self.closed = True
+
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+        self._thread.join()
+
+        try:
+            if self._preallocated:
+                # the unwritten rest would be taken for downloaded data
+                self._fh.truncate(self._written)
+
+            self._check()
+
+            if self._fsync is not None and self._fsync is not False:
+                self._sync()
+
+        finally:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_response(response, chunksize=65536, until=None):
+    """ Read response body, decompressing gzip or deflate content encoding.
+
+    The body is decompressed chunk by chunk as it arrives.  If until is
+    given, until(data, start) is called with the data read so far (a
+    bytearray) and the offset of the newly read part after each chunk,
+    reading stops early once it returns True.  As the data before start
+    was checked already, until only needs to search from about start.
+    Returns bytes.
+
+    """
+    encoding = (response.headers.get('Content-Encoding') or '').lower()
+
+    if encoding in ('gzip', 'x-gzip'):
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    elif encoding == 'deflate':
+        decomp = zlib.decompressobj()
+
+    elif until is None:
+        return response.read()
+
+    else:
+        decomp = None
+
+    data, first = bytearray(), True
+
+    while True:
+        chunk = response.read(chunksize)
+
+        if not chunk:
+            break
+
+        start = len(data)
+
+        if decomp is None:
+            data += chunk
+
+        else:
+            try:
+                data += decomp.decompress(chunk)
+
+            except zlib.error:
+                if not (first and encoding == 'deflate'):
+                    raise
+
+                # some servers send raw deflate data without the zlib header
+                decomp = zlib.decompressobj(-zlib.MAX_WBITS)
+                data += decomp.decompress(chunk)
+
+        first = False
+
+        if until and until(data, start):
+            response.close()
+            return bytes(data)
+
+    if decomp:
+        data += decomp.flush()
+
+    return bytes(data)
+
+
+class GdataGovernor(object):
+
+    """ Quota accounting and rate limiting for gdata api calls.
+
+    Calls are admitted through a token bucket refilled at g.gdata_rate tokens
+    per second and holding at most g.gdata_burst tokens; callers finding the
+    bucket empty wait for a token instead of failing.  Every admitted call is
+    charged the cost of its endpoint from g.gdata_costs.  If g.gdata_quota is
+    set, a call that would exceed it within the current quota period raises
+    GdataError without contacting the api.
+
+    """
+
+    def __init__(self):
+        """ Set initial values. """
+        self._lock = threading.Lock()
+        self._tokens = None
+        self._last = time.time()
+        self._backoff_until = 0
+        self.reset()
+
+    def reset(self):
+        """ Reset all counters and start a new quota period. """
+        with self._lock:
+            self._period_start = time.time()
+            self._units = 0
+            self._endpoints = {}
+            self._calls = 0
+            self._waits = 0
+            self._wait_time = 0.0
+            self._throttled = 0
+
+    def _refill(self, now):
+        """ Add tokens accrued since the last refill. """
+        burst = max(g.gdata_burst, 1)
+
+        if self._tokens is None:
+            self._tokens = float(burst)
+
+        elapsed = max(now - self._last, 0)
+        self._tokens = min(burst, self._tokens + elapsed * (g.gdata_rate or 0))
+        self._last = now
+
+    def acquire(self, api):
+        """ Block until a call to api may be made.  Return its quota cost. """
+        cost = g.gdata_costs.get(api, 1)
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.time()
+
+                if now - self._period_start >= g.gdata_quota_period:
+                    self._period_start, self._units = now, 0
+                    self._endpoints = {}
+
+                if (g.gdata_quota is not None and
+                        self._units + cost > g.gdata_quota):
+                    raise GdataError("Gdata quota exhausted: %d of %d units "
+                                     "used" % (self._units, g.gdata_quota))
+
+                self._refill(now)
+                delay = max(self._backoff_until - now, 0)
+
+                if not delay and (not g.gdata_rate or self._tokens >= 1):
+                    self._tokens = max(self._tokens - 1, 0)
+                    self._units += cost
+                    self._calls += 1
+                    self._endpoints[api] = self._endpoints.get(api, 0) + cost
+
+                    if waited:
+                        self._waits += 1
+                        self._wait_time += waited
+
+                    return cost
+
+                if not delay:
+                    delay = (1 - self._tokens) / g.gdata_rate
+
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self, delay):
+        """ Hold back all callers for delay seconds, eg. after an api
+        rate limit error. """
+        with self._lock:
+            self._backoff_until = max(self._backoff_until, time.time() + delay)
+            self._tokens = 0
+            self._throttled += 1
+
+    def stats(self):
+        """ Return a dict of counters for monitoring. """
+        with self._lock:
+            quota = g.gdata_quota
+            return dict(calls=self._calls,
+                        units=self._units,
+                        quota=quota,
+                        quota_remaining=None if quota is None
+                        else max(quota - self._units, 0),
+                        period_start=self._period_start,
+                        endpoints=dict(self._endpoints),
+                        waits=self._waits,
+                        wait_time=self._wait_time,
+                        throttled=self._throttled)
+
+
+gdata_governor = GdataGovernor()
+
+
+class ThroughputStats(object):
+
+    """ Counters of download throughput checks, see ThroughputMonitor. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._windows = self._throttled = self._reconnects = 0
+            self._bytes = 0
+            self._time = 0.0
+
+    def record_window(self, nbytes, elapsed, throttled):
+        """ Record a measured window. """
+        with self._lock:
+            self._windows += 1
+            self._throttled += throttled
+            self._bytes += nbytes
+            self._time += elapsed
+
+    def record_reconnect(self):
+        with self._lock:
+            self._reconnects += 1
+
+    def stats(self):
+        """ Return a dict of counters for monitoring. """
+        with self._lock:
+            return dict(windows=self._windows,
+                        throttled=self._throttled,
+                        reconnects=self._reconnects,
+                        mean_rate=self._bytes / self._time if self._time
+                        else None)
+
+
+throughput_stats = ThroughputStats()
+
+
+class ThroughputMonitor(object):
+
+    """ Detect a download being throttled.
+
+    update() is called with the size of each chunk received and the time
+    spent waiting for it, and returns True when the throughput over the
+    last window seconds of waiting stayed below min_rate bytes per second.
+    Only the time blocked on the network counts, so a slow consumer (eg. a
+    disk the data is written to) is not mistaken for throttling.  A
+    min_rate of None disables monitoring.
+
+    """
+
+    def __init__(self, min_rate, window=None, stats=None):
+        self.min_rate = min_rate
+        self.window = window or g.throttle_window
+        self.stats = stats or throughput_stats
+        self.reset()
+
+    def reset(self):
+        """ Start a new window, eg. after reconnecting. """
+        self._elapsed = 0.0
+        self._bytes = 0
+
+    def update(self, nbytes, duration):
+        """ Account nbytes received in duration seconds.  Return True if
+        throttled. """
+        if not self.min_rate:
+            return False
+
+        self._bytes += nbytes
+        self._elapsed += duration
+        elapsed = self._elapsed
+
+        if elapsed < self.window:
+            return False
+
+        throttled = self._bytes < self.min_rate * elapsed
+        self.stats.record_window(self._bytes, elapsed, throttled)
+
+        if throttled:
+            dbg("Throughput %.0f B/s below %.0f B/s", self._bytes / elapsed,
+                self.min_rate)
+
+        self.reset()
+        return throttled
+
+
+_RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def _gdata_retryable(error):
+    """ Retry predicate for gdata calls, includes api rate limit errors. """
+    if getattr(error, 'gdata_reason', None) in _RATE_LIMIT_REASONS:
+        return True
+
+    return retry_policy.retryable(error)
+
+
 def call_gdata(api, qs):
     """Make a request to the youtube gdata api."""
     qs = dict(qs)
     qs['key'] = g.api_key
     url = g.urls['gdata'] + api + '?' + urlencode(qs)
+    limited = [0]  # rate limit errors so far, for the backoff
+
+    def fetch():
+        """ Fetch url once, recording api error details on failure. """
+        gdata_governor.acquire(api)
+
+        try:
+            with measure("gdata", url) as event:
+                request = build_request(url, compressed=True)
+                response = g.opener.open(request)
+                event.status = response.getcode()
+                data = read_response(response)
+                event.bytes = len(data)
+
+            return data
+        except HTTPError as e:
+            e.gdata_reason = None
+            try:
+                errdata = e.read().decode()
+                error = json.loads(errdata)['error']
+                e.gdata_reason = error.get('errors', [{}])[0].get('reason')
+                e.gdata_errmsg = ('Youtube Error %d: %s' %
+                                  (e.getcode(), error['message']))
+            except:
+                e.gdata_errmsg = str(e)
+
+            if e.getcode() == 429 or e.gdata_reason in _RATE_LIMIT_REASONS:
+                # the next attempt waits for the governor, not the policy
+                gdata_governor.throttle(retry_policy.delay(limited[0], e))
+                limited[0] += 1
+                e.throttled = True
+
+            # a bare raise would raise the error handled above on Python 2
+            raise e
 
     try:
-        data = g.opener.open(url).read().decode('utf-8')
+        data = retry_policy.call(fetch, url, _gdata_retryable)
     except HTTPError as e:
-        try:
-            errdata = e.file.read().decode()
-            error = json.loads(errdata)['error']['message']
-            errmsg = 'Youtube Error %d: %s' % (e.getcode(), error)
-        except:
-            errmsg = str(e)
-        raise GdataError(errmsg)
+        raise GdataError(e.gdata_errmsg)
 
-    return json.loads(data)
+    return json_loads(data)
 
 
 def utf8_replace(txt):
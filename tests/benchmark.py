@@ -0,0 +1,335 @@
+# encoding: utf8
+
+""" Benchmarks for pafy.
+
+Usage:
+
+    python tests/benchmark.py <benchmark> [arguments]
+
+Run without arguments to list the available benchmarks.  Benchmarks that
+resolve videos need network access.
+
+"""
+
+from __future__ import print_function
+import sys
+import time
+
+import pafy
+from pafy import g
+
+
+BENCHMARKS = {}
+VIDEOIDS = ("ukm64IUANwE", "SeIJmciN8mo", "rYEDA3JcQqw")
+
+
+def benchmark(fn):
+    """ Register fn as a benchmark. """
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+class CountingOpener(object):
+
+    """ Wrap an opener, counting the response bytes read from the wire. """
+
+    def __init__(self, opener):
+        self.opener = opener
+        self.addheaders = opener.addheaders
+        self.bytes = 0
+        self.requests = 0
+
+    def open(self, *args, **kwargs):
+        response = self.opener.open(*args, **kwargs)
+        self.requests += 1
+        read = response.read
+
+        def counting_read(*a):
+            data = read(*a)
+            self.bytes += len(data)
+            return data
+
+        response.read = counting_read
+        return response
+
+
+@benchmark
+def wire_bytes(*videoids):
+    """ Bytes on the wire per resolved video, with and without compression.
+
+    Only requests made through pafy's opener are counted, run with
+    PAFY_BACKEND=internal to include the page fetches.
+
+    """
+    videoids = videoids or VIDEOIDS
+    accept_encoding, opener = g.accept_encoding, g.opener
+
+    try:
+        for label, encoding in (("uncompressed", None),
+                                ("compressed", accept_encoding)):
+            g.accept_encoding = encoding
+            g.opener = counter = CountingOpener(opener)
+            t0 = time.time()
+
+            for videoid in videoids:
+                pafy.new(videoid, gdata=True)
+
+            elapsed = time.time() - t0
+            print("%-13s %10d bytes/video  %3d requests  %6.2fs" %
+                  (label, counter.bytes // len(videoids), counter.requests,
+                   elapsed))
+
+    finally:
+        g.accept_encoding, g.opener = accept_encoding, opener
+
+
+@benchmark
+def watchpage_bytes(*videoids):
+    """ Watch page bytes per video, the whole page against those read now.
+
+    The watch page is read up to the age gate or player config.
+
+    """
+    from pafy import backend_internal
+    videoids = videoids or VIDEOIDS
+    opener = g.opener
+    totals = [0, 0]
+
+    try:
+        for videoid in videoids:
+            url = g.urls['watchv'] % videoid
+            g.opener = counter = CountingOpener(opener)
+            pafy.pafy.fetch_decode(url)
+            full = counter.bytes
+            g.opener = counter = CountingOpener(opener)
+            backend_internal.fetch_watchpage(url)
+            read = counter.bytes
+            totals[0] += full
+            totals[1] += read
+            print("%s %8d bytes  read %8d  saved %8d" %
+                  (videoid, full, read, full - read))
+
+    finally:
+        g.opener = opener
+
+    print("mean saved per video: %d bytes" %
+          ((totals[0] - totals[1]) // len(videoids)))
+
+
+def _sample_gdata_response(items=50):
+    """ Return a synthetic gdata videos response as json bytes. """
+    import json
+    item = {
+        "kind": "youtube#video", "etag": "x" * 27, "id": "ukm64IUANwE",
+        "snippet": {"publishedAt": "2013-03-19T23:43:42.000Z",
+                    "channelId": "UCQ7dFBzZGlBvtU2hCecsBBg",
+                    "title": "Getting started with automated testing",
+                    "description": "Lorem ipsum dolor sit amet. " * 40,
+                    "thumbnails": dict((k, {"url": "https://i.ytimg.com/vi/"
+                                            "ukm64IUANwE/%s.jpg" % k,
+                                            "width": 480, "height": 360})
+                                       for k in ("default", "medium",
+                                                 "high", "standard")),
+                    "channelTitle": "Next Day Video",
+                    "tags": ["python", "testing", "pycon"] * 5,
+                    "categoryId": "27"},
+        "contentDetails": {"duration": "PT30M37S", "dimension": "2d",
+                           "definition": "hd", "caption": "false"},
+        "statistics": {"viewCount": "91234", "likeCount": "1042",
+                       "dislikeCount": "12", "commentCount": "31"},
+    }
+    return json.dumps({"kind": "youtube#videoListResponse",
+                       "items": [item] * items}).encode("utf8")
+
+
+@benchmark
+def json_decode(*paths):
+    """ Compare json decoders on recorded (or synthetic) responses.
+
+    Pass paths of recorded gdata or playlist responses, a synthetic 50
+    item videos response is used otherwise.
+
+    """
+    from pafy import util
+
+    payloads = []
+    for path in paths:
+        with open(path, "rb") as f:
+            payloads.append(f.read())
+    payloads = payloads or [_sample_gdata_response()]
+    size = sum(len(p) for p in payloads)
+    rounds = 200
+
+    for name, _ in util._json_backends:
+        try:
+            util.set_json_backend(name)
+        except ImportError:
+            print("%-11s not installed" % name)
+            continue
+
+        t0 = time.time()
+        for _ in range(rounds):
+            for payload in payloads:
+                util.json_loads(payload)
+        elapsed = time.time() - t0
+        print("%-11s %8.1f MB/s" % (name, size * rounds / elapsed / 2 ** 20))
+
+    util.set_json_backend()
+
+
+@benchmark
+def import_time(runs=20):
+    """ Time import pafy in fresh interpreters. """
+    import os
+    import subprocess
+
+    code = "import time; t0 = time.time(); import pafy; print(time.time() - t0)"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    times = []
+
+    for _ in range(int(runs)):
+        out = subprocess.check_output([sys.executable, "-c", code], env=env)
+        times.append(float(out) * 1000)
+
+    times.sort()
+    print("import pafy (backend %s): median %.1f ms, min %.1f ms, max %.1f ms"
+          % (pafy.backend, times[len(times) // 2], times[0], times[-1]))
+
+
+def _sample_ydl_info(videoid="ukm64IUANwE", nformats=24):
+    """ Return a synthetic youtube-dl info dict with nformats formats. """
+    headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) " * 3,
+               "Accept-Charset": "ISO-8859-1,utf-8;q=0.7,*;q=0.7",
+               "Accept": "text/html,application/xhtml+xml,application/xml",
+               "Accept-Encoding": "gzip, deflate",
+               "Accept-Language": "en-us,en;q=0.5"}
+    formats = []
+
+    for n in range(nformats):
+        audio = n % 3 == 0
+        fmt = {
+            "format_id": str(130 + n), "ext": "m4a" if audio else "mp4",
+            "url": "https://r4---sn-abc.googlevideo.com/videoplayback?"
+                   "id=%s&itag=%d&" % (videoid, 130 + n) + "x=y&" * 120,
+            "acodec": "mp4a.40.2" if audio else "none",
+            "vcodec": "none" if audio else "avc1.4d401e",
+            "abr": 128 if audio else None, "tbr": 500.0 + n,
+            "width": None if audio else 640, "height": None if audio else 360,
+            "filesize": 1000000 + n, "format_note": "DASH audio" if audio
+            else "360p", "format": "%d - audio only" % n,
+            "protocol": "https", "fps": None if audio else 30,
+            "http_headers": dict(headers),
+            "fragments": [{"path": "sq/%d" % i, "duration": 5.0}
+                          for i in range(40)],
+        }
+        formats.append(dict((k, v) for k, v in fmt.items() if v is not None))
+
+    return {
+        "id": videoid, "title": "Getting started with automated testing",
+        "uploader": "Next Day Video", "uploader_id": "NextDayVideo",
+        "average_rating": 4.9, "duration": 1837, "view_count": 91234,
+        "like_count": 1042, "dislike_count": 12, "categories": ["Education"],
+        "description": "Lorem ipsum dolor sit amet. " * 40,
+        "tags": ["python", "testing"] * 10,
+        "thumbnails": [{"url": "https://i.ytimg.com/vi/%s/%d.jpg"
+                        % (videoid, n), "id": str(n)} for n in range(4)],
+        "formats": formats, "requested_formats": formats[-2:],
+        "http_headers": dict(headers), "webpage_url":
+        "https://www.youtube.com/watch?v=%s" % videoid,
+    }
+
+
+@benchmark
+def ytdl_overhead(videos=500):
+    """ Per-video overhead of the youtube-dl backend, stubbed extractor.
+
+    extract_info is replaced by a stub returning a canned info dict, so
+    the time measured is pafy's own work plus YoutubeDL setup.
+
+    """
+    try:
+        import youtube_dl
+    except ImportError:
+        print("youtube-dl not installed")
+        return
+
+    from pafy import backend_youtube_dl
+    info = _sample_ydl_info()
+    extract_info = youtube_dl.YoutubeDL.extract_info
+    youtube_dl.YoutubeDL.extract_info = lambda self, *a, **kw: dict(info)
+    pool = backend_youtube_dl.ydl_pool
+    maxidle = pool.maxidle
+
+    try:
+        for label, idle in (("new instance per video", 0),
+                            ("pooled instances", maxidle)):
+            pool.clear()
+            pool.maxidle = idle
+            t0 = time.time()
+
+            for n in range(int(videos)):
+                backend_youtube_dl.YtdlPafy("%011d" % n)
+
+            elapsed = time.time() - t0
+            print("%-24s %8.3f ms/video" % (label,
+                                            elapsed * 1000 / int(videos)))
+
+    finally:
+        youtube_dl.YoutubeDL.extract_info = extract_info
+        pool.maxidle = maxidle
+        pool.clear()
+
+
+@benchmark
+def ytdl_memory(videos=2000):
+    """ Memory retained by youtube-dl backend videos, stubbed extractor. """
+    import tracemalloc
+
+    try:
+        import youtube_dl
+    except ImportError:
+        print("youtube-dl not installed")
+        return
+
+    from pafy import backend_youtube_dl
+    extract_info = youtube_dl.YoutubeDL.extract_info
+    youtube_dl.YoutubeDL.extract_info = \
+        lambda self, url, *a, **kw: _sample_ydl_info(url)
+    keep = g.keep_ydl_info
+
+    try:
+        for label, keep_info in (("full info dicts", True),
+                                 ("compacted", False)):
+            g.keep_ydl_info = keep_info
+            tracemalloc.start()
+            cache = []
+
+            for n in range(int(videos)):
+                video = backend_youtube_dl.YtdlPafy("%011d" % n)
+                video.allstreams
+                cache.append(video)
+
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print("%-16s %8.1f KB/video" % (label,
+                                            current / 1024.0 / int(videos)))
+            del cache
+
+    finally:
+        youtube_dl.YoutubeDL.extract_info = extract_info
+        g.keep_ydl_info = keep
+
+
+def main():
+    """ Run the benchmark named on the command line. """
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        for name in sorted(BENCHMARKS):
+            doc = BENCHMARKS[name].__doc__.strip().splitlines()[0]
+            print("%-20s %s" % (name, doc))
+        return
+
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
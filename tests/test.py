@@ -5,7 +5,10 @@
 from __future__ import unicode_literals
 from functools import wraps
 import hashlib
+import io
+import threading
 import pafy
+from pafy import g, util, backend_shared
 import time
 import os
 import sys
@@ -16,6 +19,14 @@ try:
 except ImportError:
     import unittest
 
+if sys.version_info[:2] >= (3, 0):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
 
 def stdout_to_null(fn):
     """  Supress stdout. """
@@ -31,6 +42,138 @@ def stdout_to_null(fn):
     return wrapper
 
 
+class LocalServer(ThreadingMixIn, HTTPServer):
+
+    """ Local http server replying with canned responses.
+
+    responses is a list of (status, headers, body) tuples served in order,
+    the last one is repeated.  Received request headers are kept in
+    self.requests, with their names title cased (Python 2 lowercases them).
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, responses, handler=None):
+        self.responses = list(responses)
+        self.requests = []
+        HTTPServer.__init__(self, ("127.0.0.1", 0), handler or LocalHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, path="/"):
+        """ Return url of path on this server. """
+        return "http://127.0.0.1:%d%s" % (self.server_address[1], path)
+
+    def record(self, handler):
+        """ Record the request headers of handler. """
+        self.requests.append(dict((k.title(), v)
+                                  for k, v in handler.headers.items()))
+
+    def next_response(self, handler):
+        """ Record request, return the response to send. """
+        self.record(handler)
+        if len(self.responses) > 1:
+            return self.responses.pop(0)
+        return self.responses[0]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+
+    """ Request handler for LocalServer. """
+
+    def do_GET(self):
+        status, headers, body = self.server.next_response(self)
+        self.send_response(status)
+        for header in headers.items():
+            self.send_header(*header)
+        if "Content-Length" not in headers:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangeHandler(LocalHandler):
+
+    """ Serve byte ranges of the body of the first canned response. """
+
+    def do_GET(self):
+        self.server.record(self)
+        body = self.server.responses[0][2]
+        byterange = self.headers.get("Range", "bytes=0-")
+        start, end = byterange.split("=")[1].split("-")
+        end = min(int(end or len(body) - 1), len(body) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %s-%d/%d" %
+                         (start, end, len(body)))
+        self.send_header("Content-Length", str(end - int(start) + 1))
+        self.end_headers()
+        self.wfile.write(body[int(start):end + 1])
+
+
+class UnknownLengthHandler(LocalHandler):
+
+    """ Serve byte ranges of the body of the first canned response without
+    giving its length, 416 past the end. """
+
+    def do_GET(self):
+        self.server.record(self)
+        body = self.server.responses[0][2]
+        start, end = (int(n) for n in
+                      self.headers["Range"].split("=")[1].split("-"))
+
+        if start >= len(body):
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        end = min(end, len(body) - 1)
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes %d-%d/*" % (start, end))
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(body[start:end + 1])
+
+
+class ThrottledHandler(LocalHandler):
+
+    """ Serve the body of the first canned response, throttled after the
+    first 2000 bytes of each request. """
+
+    def do_GET(self):
+        self.server.record(self)
+        body = self.server.responses[0][2]
+        start = 0
+
+        if "Range" in self.headers:
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+
+        else:
+            self.send_response(200)
+
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:start + 2000])
+
+        try:
+            for pos in range(start + 2000, len(body), 100):
+                time.sleep(0.05)
+                self.wfile.write(body[pos:pos + 100])
+
+        except (IOError, OSError):
+            pass
+
+
 class Test(unittest.TestCase):
 
     """ Tests. """
@@ -135,12 +278,15 @@ class Test(unittest.TestCase):
     @stdout_to_null
     def test_pafy__invalid_win_filename(self):
         """ Test Windows and colon character in video name. """
-        os.name = "nt"
-        vid = pafy.new("http://www.youtube.com/watch?v=K-TNJSBrFEk")
-        audio = vid.getbestaudio()
-        expected = ("Jon Meacham_ _Thomas Jefferson_ the Art of Power_ _ Talks"
-                    " at Google.m4a")
-        self.assertEqual(expected, audio.generate_filename())
+        osname, os.name = os.name, "nt"
+        try:
+            vid = pafy.new("http://www.youtube.com/watch?v=K-TNJSBrFEk")
+            audio = vid.getbestaudio()
+            expected = ("Jon Meacham_ _Thomas Jefferson_ the Art of Power_ _ "
+                        "Talks at Google.m4a")
+            self.assertEqual(expected, audio.generate_filename())
+        finally:
+            os.name = osname
 
     @stdout_to_null
     def test_pafy_download_to_dir(self):
@@ -217,6 +363,1239 @@ class Test(unittest.TestCase):
         for pl in Test.playlists:
             pickle.dumps(pl['fetched'])
 
+class TestGdataGovernor(unittest.TestCase):
+
+    """ Offline tests for gdata quota accounting and rate limiting. """
+
+    def setUp(self):
+        self.saved = (g.gdata_rate, g.gdata_burst, g.gdata_quota)
+        self.governor = util.GdataGovernor()
+
+    def tearDown(self):
+        g.gdata_rate, g.gdata_burst, g.gdata_quota = self.saved
+
+    def test_rate_limit_waits(self):
+        """ Calls beyond the burst wait for tokens instead of failing. """
+        g.gdata_rate, g.gdata_burst = 50.0, 2
+        t0 = time.time()
+        for _ in range(4):
+            self.governor.acquire('videos')
+        stats = self.governor.stats()
+        self.assertEqual(stats['calls'], 4)
+        self.assertEqual(stats['waits'], 2)
+        self.assertTrue(time.time() - t0 >= 0.03)
+
+    def test_quota_accounting(self):
+        """ Endpoint costs are charged and the quota is enforced. """
+        g.gdata_rate, g.gdata_quota = None, 102
+        self.governor.acquire('search')
+        self.governor.acquire('playlistItems')
+        stats = self.governor.stats()
+        self.assertEqual(stats['units'], 101)
+        self.assertEqual(stats['endpoints'], {'search': 100,
+                                              'playlistItems': 1})
+        self.assertEqual(stats['quota_remaining'], 1)
+        self.assertRaises(pafy.GdataError, self.governor.acquire, 'search')
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    """ Retry and circuit breaker tests against a local server. """
+
+    def setUp(self):
+        self.policy = util.RetryPolicy(attempts=3, backoff=0.001,
+                                       breaker_threshold=2)
+        self.saved = util.retry_policy
+        util.retry_policy = self.policy
+
+    def tearDown(self):
+        util.retry_policy = self.saved
+        self.server.stop()
+
+    def test_retry_until_success(self):
+        """ Transient 503s are retried, Retry-After is honored. """
+        self.server = LocalServer([(503, {"Retry-After": "0"}, b""),
+                                   (502, {}, b""),
+                                   (200, {"Content-Type": "text/plain; "
+                                          "charset=utf-8"}, b"ok")])
+        self.assertEqual(pafy.pafy.fetch_decode(self.server.url()), "ok")
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_bounded_attempts(self):
+        """ Persistent failures give up after the configured attempts. """
+        self.server = LocalServer([(503, {}, b"")])
+        url = self.server.url()
+        self.assertRaises(util.HTTPError, pafy.pafy.fetch_decode, url)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_circuit_breaker(self):
+        """ Repeated failed calls suspend requests to the host. """
+        self.server = LocalServer([(500, {}, b"")])
+        url = self.server.url()
+        self.assertRaises(util.HTTPError, pafy.pafy.fetch_decode, url)
+        self.assertRaises(util.HTTPError, pafy.pafy.fetch_decode, url)
+        self.assertRaises(util.CircuitOpenError, pafy.pafy.fetch_decode, url)
+        self.assertEqual(len(self.server.requests), 6)
+
+    def test_throttled_not_delayed(self):
+        """ Errors the caller already waits for are retried at once. """
+        self.server = LocalServer([])
+        policy = util.RetryPolicy(attempts=2, backoff=100, max_backoff=100)
+        errors = [util.URLError("rate limited")]
+        errors[0].throttled = True
+
+        def func():
+            if errors:
+                raise errors.pop()
+            return "ok"
+
+        t0 = time.time()
+        self.assertEqual(policy.call(func, "http://x/"), "ok")
+        self.assertTrue(time.time() - t0 < 1)
+
+    def test_gdata_rate_limit_backoff(self):
+        """ The governor holds gdata calls back longer after each 429. """
+        self.server = LocalServer([(429, {}, b"{}"), (429, {}, b"{}"),
+                                   (200, {}, b'{"items": []}')])
+        urls = dict(g.urls)
+        self.addCleanup(setattr, g, "urls", urls)
+        g.urls['gdata'] = self.server.url("/")
+        delays = []
+        throttle = util.gdata_governor.throttle
+        util.gdata_governor.throttle = lambda delay: (delays.append(delay),
+                                                      throttle(delay))
+        self.addCleanup(delattr, util.gdata_governor, "throttle")
+        uniform = util.random.uniform
+        util.random.uniform = lambda a, b: b
+        self.addCleanup(setattr, util.random, "uniform", uniform)
+        self.assertEqual(util.call_gdata('videos', {}), {"items": []})
+        self.assertEqual(delays, [0.001, 0.002])
+
+    def test_no_retry_on_client_error(self):
+        """ Client errors are raised immediately. """
+        self.server = LocalServer([(404, {}, b"")])
+        self.assertRaises(util.HTTPError, pafy.pafy.fetch_decode,
+                          self.server.url())
+        self.assertEqual(len(self.server.requests), 1)
+
+
+class TestCompression(unittest.TestCase):
+
+    """ Compressed response decoding tests against a local server. """
+
+    def tearDown(self):
+        self.server.stop()
+
+    def fetch(self, encoding, body):
+        self.server = LocalServer([(200, {"Content-Encoding": encoding,
+                                          "Content-Type": "text/plain; "
+                                          "charset=utf-8"}, body)])
+        return pafy.pafy.fetch_decode(self.server.url())
+
+    def test_gzip(self):
+        """ gzip responses are decompressed. """
+        import gzip
+        import io
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+            f.write("pafy ✓".encode("utf8") * 1000)
+        self.assertEqual(self.fetch("gzip", buf.getvalue()), "pafy ✓" * 1000)
+        self.assertIn("gzip", self.server.requests[0]["Accept-Encoding"])
+
+    def test_deflate(self):
+        """ zlib wrapped and raw deflate responses are decompressed. """
+        import zlib
+        data = b"pafy" * 1000
+        self.assertEqual(self.fetch("deflate", zlib.compress(data)),
+                         "pafy" * 1000)
+        self.server.stop()
+        raw = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        body = raw.compress(data) + raw.flush()
+        self.assertEqual(self.fetch("deflate", body), "pafy" * 1000)
+
+
+class TestJsonBackend(unittest.TestCase):
+
+    """ Tests for selecting the json decoder. """
+
+    def tearDown(self):
+        pafy.set_json_backend()
+
+    def test_stdlib_from_bytes(self):
+        """ The stdlib fallback decodes utf-8 bytes. """
+        self.assertEqual(pafy.set_json_backend("json"), "json")
+        self.assertEqual(util.json_loads('{"t": "✓"}'.encode("utf8")),
+                         {"t": "✓"})
+
+    def test_custom_and_unknown(self):
+        """ A callable may be given, unknown names are rejected. """
+        pafy.set_json_backend(lambda data: "decoded")
+        self.assertEqual(util.json_loads(b"{}"), "decoded")
+        self.assertRaises(ValueError, pafy.set_json_backend, "nojson")
+
+
+class TestImport(unittest.TestCase):
+
+    """ Guard against heavy imports in import pafy. """
+
+    def imported_modules(self, backend):
+        import subprocess
+        env = dict(os.environ, PAFY_BACKEND=backend)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        code = "import sys, pafy; print(' '.join(sys.modules))"
+        out = subprocess.check_output([sys.executable, "-c", code], env=env)
+        return out.decode("utf8").split()
+
+    def test_lazy_import(self):
+        """ Backends, playlist and channel modules load on first use. """
+        modules = self.imported_modules("internal")
+        for name in ("pafy.backend_internal", "pafy.backend_shared",
+                     "pafy.playlist", "pafy.channel"):
+            if sys.version_info[:2] >= (3, 7) or "backend" in name:
+                self.assertNotIn(name, modules)
+
+        if pafy.pafy._module_available("youtube_dl"):
+            self.assertNotIn("youtube_dl", self.imported_modules("youtube-dl"))
+
+
+try:
+    import youtube_dl
+except ImportError:
+    youtube_dl = None
+
+
+@unittest.skipUnless(youtube_dl, "youtube-dl not installed")
+class TestYtdlBackend(unittest.TestCase):
+
+    """ Offline tests for the youtube-dl backend. """
+
+    def stub_extract_info(self, info, calls=None):
+        """ Replace YoutubeDL.extract_info with a stub returning info. """
+        def extract_info(ydl, url, download=True, process=True):
+            if calls is not None:
+                calls.append((ydl.params.get('extract_flat'), process))
+            return dict(info)
+
+        saved = youtube_dl.YoutubeDL.extract_info
+        youtube_dl.YoutubeDL.extract_info = extract_info
+        self.addCleanup(setattr, youtube_dl.YoutubeDL, 'extract_info', saved)
+
+    def test_reuse(self):
+        """ Instances are reused per option set, never shared. """
+        from pafy.backend_youtube_dl import YdlPool
+        pool, opts = YdlPool(), {'quiet': True}
+        with pool.checkout(opts) as first:
+            with pool.checkout(opts) as second:
+                self.assertIsNot(first, second)
+        with pool.checkout(dict(opts)) as third:
+            self.assertIn(third, (first, second))
+        with pool.checkout({'quiet': False}) as other:
+            self.assertNotIn(other, (first, second))
+        self.assertEqual(pool.created, 3)
+        pool.clear()
+
+    def test_options_not_shared(self):
+        """ Per video options do not leak into the global defaults. """
+        from pafy.backend_youtube_dl import YtdlPafy, YdlOptions
+        defaults = dict(g.def_ydl_opts)
+        vid = YtdlPafy("DsAn_n6O5Ns", basic=False, ydl_opts={'proxy': 'x'})
+        self.assertEqual(g.def_ydl_opts, defaults)
+        self.assertEqual(vid._ydl_opts['proxy'], 'x')
+        self.assertEqual(vid._ydl_opts,
+                         YdlOptions(defaults).merge({'proxy': 'x'}))
+        self.assertEqual(hash(vid._ydl_opts),
+                         hash(YdlOptions(dict(defaults, proxy='x'))))
+
+    def test_flat(self):
+        """ Flat videos extract formats only when streams are used. """
+        from pafy.backend_youtube_dl import YtdlPafy
+        calls = []
+        fmt = {'format_id': '140', 'ext': 'm4a', 'url': 'http://x/140',
+               'acodec': 'mp4a', 'vcodec': 'none', 'abr': 128}
+        self.stub_extract_info({'title': 'flat', 'formats': [fmt],
+                                'thumbnail': 'x'}, calls)
+        vid = YtdlPafy("DsAn_n6O5Ns", flat=True)
+        self.assertEqual(vid.title, 'flat')
+        self.assertEqual(calls, [('in_playlist', False)])
+        self.assertEqual(list(vid.timings), ['extract', 'total'])
+        self.assertEqual([s.itag for s in vid.allstreams], ['140'])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(list(vid.timings), ['extract', 'total', 'formats',
+                                             'streams'])
+        vid.refresh()
+        self.assertEqual(calls[1], (None, True))
+
+    def test_compact_info(self):
+        """ Only the fields pafy uses are retained. """
+        from pafy.backend_youtube_dl import YtdlPafy
+        fmt = {'format_id': '140', 'ext': 'm4a', 'url': 'http://x/140',
+               'acodec': 'mp4a', 'vcodec': 'none', 'abr': 128,
+               'filesize': 10, 'http_headers': {'a': 'b'}, 'fragments': []}
+        self.stub_extract_info({'title': 't', 'thumbnail': 'x',
+                                'formats': [fmt]})
+        vid = YtdlPafy("DsAn_n6O5Ns")
+        self.assertIsNone(vid._ydl_info)
+        stream = vid.getbestaudio()
+        self.assertEqual(stream.get_filesize(), 10)
+        self.assertNotIn('http_headers', stream._info)
+
+        g.keep_ydl_info = True
+        try:
+            vid = YtdlPafy("DsAn_n6O5Ns")
+            self.assertEqual(vid._ydl_info['formats'][0], fmt)
+            self.assertEqual(vid.audiostreams[0]._info, fmt)
+        finally:
+            g.keep_ydl_info = False
+
+    def test_download(self):
+        """ Downloads go through pafy's reader, hashing as data arrives. """
+        import tempfile
+        from pafy.backend_youtube_dl import YtdlPafy
+        server = LocalServer([(200, {}, b"a" * 40000)])
+        self.addCleanup(server.stop)
+        fmt = {'format_id': '140', 'ext': 'm4a', 'url': server.url(),
+               'acodec': 'mp4a', 'vcodec': 'none', 'abr': 128,
+               'filesize': 40000}
+        self.stub_extract_info({'title': 't', 'thumbnail': 'x',
+                                'formats': [fmt]})
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        stream = YtdlPafy("DsAn_n6O5Ns").getbestaudio()
+        self.assertEqual(stream.download(path, quiet=True, hashes=["sha256"]),
+                         (path, {"sha256": hashlib.sha256(b"a" * 40000)
+                                 .hexdigest()}))
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), b"a" * 40000)
+
+    def test_fragment_index(self):
+        """ Segmented formats are indexed from their fragment list. """
+        from pafy.backend_youtube_dl import YtdlPafy
+        fmt = {'format_id': '137', 'ext': 'mp4', 'vcodec': 'avc1',
+               'acodec': 'none', 'width': 1920, 'height': 1080,
+               'url': 'https://manifest.googlevideo.com/x',
+               'fragment_base_url': 'https://r1.googlevideo.com/137/',
+               'fragments': [{'url': 'https://r1.googlevideo.com/init'}] +
+                            [{'path': 'sq/%d' % n, 'duration': 5.0}
+                             for n in range(10)]}
+        self.stub_extract_info({'title': 't', 'thumbnail': 'x',
+                                'formats': [fmt]})
+        stream = YtdlPafy("DsAn_n6O5Ns").getbestvideo()
+        self.assertNotIn('fragments', stream._info)
+        self.assertEqual(stream.get_segment_index().parts(12, 14), [
+            ('https://r1.googlevideo.com/init', None),
+            ('https://r1.googlevideo.com/137/sq/2', None)])
+
+
+class FakePafy(backend_shared.BasePafy):
+
+    """ Pafy object with a given list of streams and no network access. """
+
+    def __init__(self, streams):
+        self._fake = streams
+        self.urls = {}
+        self.fetches = 0
+        super(FakePafy, self).__init__("DsAn_n6O5Ns", basic=False)
+
+    def _fetch_basic(self):
+        self.fetches += 1
+        self._have_basic = True
+        self.expiry = time.time() + g.lifespan
+
+    def _process_streams(self):
+        allstreams = []
+        for mediatype, ext, resolution, rawbitrate, codec in self._fake:
+            s = backend_shared.BaseStream(self)
+            s._mediatype, s._extension, s._codec = mediatype, ext, codec
+            s._resolution, s._rawbitrate = resolution, rawbitrate
+            s._dimensions = tuple(int(x) for x in
+                                  resolution.split("-")[0].split("x"))
+            s._threed = "3D" in resolution
+            s._itag = str(len(allstreams))
+            s._url = self.urls.get(s._itag)
+            allstreams.append(s)
+        self._streams = [s for s in allstreams if s.mediatype == "normal"]
+        self._videostreams = [s for s in allstreams if s.mediatype == "video"]
+        self._audiostreams = [s for s in allstreams if s.mediatype == "audio"]
+        self._allstreams = allstreams
+        self._build_index()
+
+
+AUDIO = ("audio", "m4a", "0x0", 131072, "mp4a")
+
+
+def served_stream(testcase, responses, handler=None, spec=AUDIO):
+    """ Return a FakePafy stream of the given spec and the LocalServer
+    serving its url, stopped when testcase is cleaned up. """
+    server = LocalServer(responses, handler)
+    testcase.addCleanup(server.stop)
+    stream = FakePafy([spec]).allstreams[0]
+    stream._url = server.url()
+    return stream, server
+
+
+class TestStreamSelection(unittest.TestCase):
+
+    """ Tests for the stream selection index and selectors. """
+
+    def setUp(self):
+        self.video = FakePafy([
+            ("normal", "mp4", "640x360", 0, ""),
+            ("normal", "webm", "640x360", 0, ""),
+            ("normal", "mp4", "1280x720-3D", 0, ""),
+            ("normal", "3gp", "176x144", 0, ""),
+            ("video", "m4v", "1920x1080", 0, "avc1"),
+            ("video", "webm", "1920x1080", 0, "vp9"),
+            ("video", "webm", "1280x720", 0, "vp9"),
+            ("video", "m4v", "854x480", 0, "avc1"),
+            ("audio", "m4a", "0x0", 131072, "mp4a"),
+            ("audio", "opus", "0x0", 163840, "opus"),
+            ("audio", "m4a", "0x0", 49152, "mp4a"),
+        ])
+
+    @staticmethod
+    def reference(streams, key, best, preftype, ftypestrict):
+        """ The selection previously done by getbest() and friends. """
+        def sortkey(x):
+            ftype = preftype == x.extension
+            return (key(x)[0], ftype, key(x)[1]) if ftypestrict else \
+                   (key(x)[0], key(x)[1], ftype)
+        if not streams:
+            return None
+        r = (max if best else min)(streams, key=sortkey)
+        if ftypestrict and preftype != "any" and r.extension != preftype:
+            return None
+        return r
+
+    def test_matches_previous_selection(self):
+        """ getbest() and friends select the same streams as before. """
+        import random
+        from pafy.selector import _videokey, _audiokey
+        rnd = random.Random(1)
+        exts, resolutions = ("mp4", "webm", "3gp"), ("640x360", "176x144",
+                                                     "1280x720-3D", "854x480")
+        for _ in range(200):
+            streams = [(rnd.choice(("normal", "video", "audio")),
+                        rnd.choice(exts), rnd.choice(resolutions),
+                        rnd.choice((48, 128, 256)), "")
+                       for _ in range(rnd.randint(0, 8))]
+            video = FakePafy(streams)
+            video._process_streams()
+            for preftype in ("any",) + exts:
+                for strict in (True, False):
+                    for best in (True, False):
+                        name = "best" if best else "worst"
+                        for suffix, lst, key in (
+                                ("", video._streams, _videokey),
+                                ("video", video._videostreams, _videokey),
+                                ("audio", video._audiostreams, _audiokey)):
+                            got = getattr(video, "get" + name + suffix)(
+                                preftype, strict)
+                            self.assertIs(got, self.reference(
+                                lst, key, best, preftype, strict))
+
+    def test_selectors(self):
+        """ Selector expressions pick the expected streams. """
+        video = self.video
+        bestvideo = video.select("bestvideo[height<=720][ext=webm]")
+        self.assertEqual((bestvideo.resolution, bestvideo.extension),
+                         ("1280x720", "webm"))
+        pair = video.select("bestvideo[codec^=avc]+bestaudio[ext=m4a]")
+        self.assertEqual([s.itag for s in pair], ["4", "8"])
+        self.assertIs(video.select("bestvideo[height>2000]/best"),
+                      video.getbest())
+        self.assertIs(video.select("worstaudio"), video.getworstaudio())
+        self.assertEqual(video.select("best[3d=1]").resolution, "1280x720-3D")
+        self.assertIsNone(video.select("bestaudio[abr>500]"))
+        for bad in ("top", "best[size>1]", "best[height^=7]", "best[x",
+                    "bestvideo+bestaudio+best"):
+            self.assertRaises(ValueError, video.select, bad)
+
+    def test_selector_cache_bounded(self):
+        from pafy import selector
+        for n in range(selector._MAX_SELECTORS + 10):
+            selector.get_selector("best[height<=%d]" % n)
+        self.assertTrue(len(selector._selectors) <= selector._MAX_SELECTORS)
+        spec = "bestaudio[abr>1]"
+        self.assertIs(selector.get_selector(spec),
+                      selector.get_selector(spec))
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    """ Tests for the background download writer. """
+
+    def setUp(self):
+        import tempfile
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+        self.addCleanup(setattr, g, "preallocate", g.preallocate)
+        g.preallocate = True
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def test_write(self):
+        """ Preallocated space beyond the data written is released. """
+        writer = util.WriteBehind(self.path, size=100000, buffer_size=1000)
+        for n in range(50):
+            writer.write(bytes(bytearray([n])) * 100)
+        self.assertEqual(writer.tell(), 5000)
+        writer.close()
+        writer.close()
+        self.assertEqual(self.read(), b"".join(bytes(bytearray([n])) * 100
+                                               for n in range(50)))
+
+    def test_append(self):
+        with util.WriteBehind(self.path) as writer:
+            writer.write(b"abc")
+        with util.WriteBehind(self.path, "ab", size=10) as writer:
+            self.assertEqual(writer.tell(), 3)
+            writer.write(b"def")
+        self.assertEqual(self.read(), b"abcdef")
+
+    def test_fsync_policy(self):
+        syncs = []
+        fsync = os.fsync
+        os.fsync = syncs.append
+        try:
+            with util.WriteBehind(self.path, fsync=1000) as writer:
+                for _ in range(5):
+                    writer.write(b"x" * 500)
+            self.assertEqual(len(syncs), 3)
+            with util.WriteBehind(self.path, fsync="close") as writer:
+                writer.write(b"x" * 5000)
+            self.assertEqual(len(syncs), 4)
+        finally:
+            os.fsync = fsync
+
+    def test_error(self):
+        """ Write errors are raised by the next write or close. """
+        class Broken(object):
+            def write(self, data):
+                raise IOError("disk full")
+        writer = util.WriteBehind(self.path, buffer_size=10)
+        fh, writer._fh = writer._fh, Broken()
+        writer.write(b"x" * 10)
+        self.assertRaises(IOError, writer.write, b"x" * 10)
+        writer._fh = fh
+        self.assertRaises(IOError, writer.close)
+
+    def test_download(self):
+        """ Stream.download writes through the background writer. """
+        stream, _ = served_stream(self, [(200, {}, b"d" * 100000)])
+        path = stream.download(self.path, quiet=True)
+        self.assertEqual(self.read(), b"d" * 100000)
+        self.assertFalse(os.path.exists(path + ".temp"))
+
+    def test_interrupted_download(self):
+        """ An interrupted download keeps only the data received, so it is
+        resumed where it stopped. """
+        stream, server = served_stream(self, [(200, {}, b"d" * 100000)],
+                                       RangeHandler)
+
+        def interrupt(total, done, *args):
+            if done >= 32768:
+                raise KeyboardInterrupt
+
+        self.assertRaises(KeyboardInterrupt, stream.download, self.path,
+                          quiet=True, callback=interrupt)
+        with open(self.path + ".temp", "rb") as f:
+            self.assertEqual(len(f.read()), 32768)
+        stream.download(self.path, quiet=True)
+        self.assertEqual(self.read(), b"d" * 100000)
+        self.assertEqual(server.requests[-1]["Range"], "bytes=32768-")
+
+
+class TestHashing(unittest.TestCase):
+
+    """ Tests for hashing and size checks while downloading. """
+
+    body = b"0123456789" * 5000
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "out")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def stream(self, responses):
+        return served_stream(self, responses)[0]
+
+    def test_download(self):
+        stream = self.stream([(200, {}, self.body)])
+        path, digests = stream.download(self.path, quiet=True,
+                                        hashes=["sha256", "md5"])
+        self.assertEqual(path, self.path)
+        self.assertEqual(digests, {
+            "sha256": hashlib.sha256(self.body).hexdigest(),
+            "md5": hashlib.md5(self.body).hexdigest()})
+
+    def test_resumed_download(self):
+        """ Data received before resuming is part of the digest. """
+        with open(self.path + ".temp", "wb") as f:
+            f.write(self.body[:20000])
+        stream = self.stream([(200, {}, self.body),
+                              (206, {}, self.body[20000:])])
+        _, digests = stream.download(self.path, quiet=True,
+                                     hashes="sha1")
+        self.assertEqual(digests["sha1"], hashlib.sha1(self.body).hexdigest())
+
+    def test_size_checks(self):
+        stream = self.stream([(200, {"Content-Length": "60000"}, self.body)])
+        self.assertRaises(IOError, stream.download, self.path, quiet=True)
+        self.assertTrue(os.path.exists(self.path + ".temp"))
+        stream = self.stream([(200, {}, self.body)])
+        stream._fsize = 12345
+        self.assertRaises(IOError, stream.download, self.path, quiet=True)
+        self.assertRaises(IOError, stream.open)
+
+    def test_chunk_apis(self):
+        stream = self.stream([(200, {}, self.body)])
+        digest = hashlib.sha256(self.body).hexdigest()
+        chunks = stream.iter_chunks(hashes=["sha256"])
+        self.assertEqual(b"".join(chunks), self.body)
+        self.assertEqual(chunks.hexdigests(), {"sha256": digest})
+        with stream.open(hashes=["sha256"]) as f:
+            f.read()
+            self.assertEqual(f.hexdigests(), {"sha256": digest})
+
+
+class TestUrlRefresh(unittest.TestCase):
+
+    """ Tests for refreshing expired stream urls. """
+
+    body = b"0123456789" * 5000
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "out")
+        self.video = FakePafy([("audio", "m4a", "0x0", 131072, "mp4a"),
+                               ("audio", "webm", "0x0", 65536, "opus")])
+        self.video.expiry = time.time() + g.lifespan
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def server(self, responses):
+        server = LocalServer(responses)
+        self.addCleanup(server.stop)
+        return server
+
+    def test_refresh_on_403(self):
+        """ A forbidden url is refreshed, keeping the Stream objects. """
+        old, new = self.server([(403, {}, b"")]), self.server([
+            (200, {}, self.body)])
+        stream = self.video.getbestaudio()
+        stream._url = old.url()
+        self.video.urls = {stream.itag: new.url()}
+        self.assertEqual(stream.download(self.path, quiet=True), self.path)
+        self.assertEqual(self.video.fetches, 1)
+        self.assertIs(self.video.getbestaudio(), stream)
+        self.assertEqual(stream.url, new.url())
+
+    def test_expired(self):
+        new = self.server([(200, {}, self.body)])
+        stream = self.video.getbestaudio()
+        stream._url = "http://127.0.0.1:1/expired"
+        self.video.urls = {stream.itag: new.url()}
+        self.video.expiry = time.time() - 1
+        self.assertEqual(stream.get_filesize(), len(self.body))
+        self.assertFalse(self.video.expired)
+
+    def test_resume_with_new_url(self):
+        """ A download dropped with an expired url resumes from its offset. """
+        old = self.server([(200, {"Content-Length": "50000"},
+                            self.body[:20000]), (403, {}, b"")])
+        new = self.server([(206, {}, self.body[20000:])])
+        stream = self.video.getbestaudio()
+        stream._url = old.url()
+        self.video.urls = {stream.itag: new.url()}
+        stream.download(self.path, quiet=True)
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertEqual(new.requests[0]["Range"], "bytes=20000-")
+
+    def test_stream_gone(self):
+        old = self.server([(403, {}, b"")])
+        stream = self.video.getbestaudio()
+        stream._url, stream._itag = old.url(), "140"
+        self.assertRaises(IOError, stream.download, self.path, quiet=True)
+
+
+class TestStreamReading(unittest.TestCase):
+
+    """ Tests for reading streams without downloading to a file. """
+
+    def stream(self, responses):
+        stream, self.server = served_stream(self, responses)
+        return stream
+
+    def test_iter_chunks(self):
+        stream = self.stream([(200, {}, b"x" * 40000)])
+        chunks = list(stream.iter_chunks(chunk_size=16384))
+        self.assertTrue(all(len(c) <= 16384 for c in chunks))
+        self.assertEqual(b"".join(chunks), b"x" * 40000)
+
+    def test_open_resumes(self):
+        """ A dropped connection is resumed with a Range request. """
+        stream = self.stream([(200, {"Content-Length": "10"}, b"01234"),
+                              (206, {}, b"56789")])
+        with stream.open() as f:
+            self.assertEqual(f.read(), b"0123456789")
+            self.assertEqual(f.tell(), 10)
+        self.assertEqual(self.server.requests[1]["Range"], "bytes=5-")
+
+    def test_open_gives_up(self):
+        stream = self.stream([(200, {"Content-Length": "10"}, b"01234"),
+                              (206, {"Content-Length": "5"}, b"")])
+        f = stream.open(retries=2)
+        self.assertRaises(IOError, f.read)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_throttled(self):
+        """ A throttled connection is reopened at the current offset. """
+        data = bytes(bytearray(n % 251 for n in range(10000)))
+        stream = self.stream([(200, {}, data)])
+        self.server.RequestHandlerClass = ThrottledHandler
+        stream._parent._length = 1
+        stats = pafy.throughput_stats.stats()
+        window, g.throttle_window = g.throttle_window, 0.2
+        self.addCleanup(setattr, g, "throttle_window", window)
+        chunks = stream.iter_chunks(chunk_size=500)
+        self.assertEqual(b"".join(chunks), data)
+        self.assertTrue(chunks.reader.reconnects >= 2)
+        offsets = [int(r["Range"][6:-1]) for r in self.server.requests[1:]]
+        self.assertEqual(offsets, sorted(offsets))
+        self.assertTrue(offsets[0] >= 2000)
+        after = pafy.throughput_stats.stats()
+        self.assertEqual(after["reconnects"] - stats["reconnects"],
+                         chunks.reader.reconnects)
+        self.assertTrue(after["throttled"] > stats["throttled"])
+
+    def test_slow_consumer(self):
+        """ Time spent by the consumer is not taken for throttling. """
+        data = b"x" * 10000
+        stream = self.stream([(200, {}, data)])
+        stream._parent._length = 1
+        window, g.throttle_window = g.throttle_window, 0.2
+        self.addCleanup(setattr, g, "throttle_window", window)
+        chunks = stream.iter_chunks(chunk_size=500)
+        received = []
+        for chunk in chunks:
+            received.append(chunk)
+            time.sleep(0.05)
+        self.assertEqual(b"".join(received), data)
+        self.assertEqual(chunks.reader.reconnects, 0)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_seekable_unknown_length(self):
+        data = bytes(bytearray(n % 251 for n in range(3000)))
+        self.server = LocalServer([(200, {}, data)], UnknownLengthHandler)
+        self.addCleanup(self.server.stop)
+        reader = backend_shared.RangeReader(self.server.url(),
+                                            block_size=1000, readahead=2)
+        self.assertEqual(reader.length, None)
+        self.assertRaises(IOError, reader.seek, 0, io.SEEK_END)
+        self.assertEqual(io.BufferedReader(reader, 100).read(), data)
+        self.assertEqual(reader.length, 3000)
+
+    def test_range_ignored(self):
+        """ Only one block is read from a server ignoring Range. """
+        self.server = LocalServer([(200, {}, b"x" * 100000)])
+        self.addCleanup(self.server.stop)
+        self.assertRaises(IOError, backend_shared.RangeReader,
+                          self.server.url(), block_size=1000)
+        self.server.responses = [(200, {}, b"x" * 500)]
+        reader = backend_shared.RangeReader(self.server.url(),
+                                            block_size=1000)
+        self.assertEqual(reader.read(), b"x" * 500)
+
+    def test_seekable(self):
+        """ Seekable streams fetch blocks on demand and cache them. """
+        data = bytes(bytearray(n % 251 for n in range(1000000)))
+        self.server = LocalServer([(200, {}, data)], RangeHandler)
+        self.addCleanup(self.server.stop)
+        reader = backend_shared.RangeReader(self.server.url(),
+                                            block_size=1000, cache_blocks=4,
+                                            readahead=3)
+        f = io.BufferedReader(reader, 100)
+        self.assertEqual(f.read(10), data[:10])
+        f.seek(-20, io.SEEK_END)
+        self.assertEqual(f.read(), data[-20:])
+        f.seek(500000)
+        self.assertEqual(f.read(2500), data[500000:502500])
+        self.assertEqual(self.server.requests[-1]["Range"],
+                         "bytes=501000-503999")
+        requests = reader.requests
+        f.seek(500100)
+        self.assertEqual(f.read(50), data[500100:500150])
+        self.assertEqual(reader.requests, requests)
+        self.assertEqual(len(reader._blocks), 4)
+
+
+def box(kind, payload):
+    """ Return an ISO BMFF box. """
+    import struct
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def fragmented_mp4(durations, segsize):
+    """ Return (data, init end) of an mp4 with a sidx of 1000 Hz segments. """
+    import struct
+    init = box(b"ftyp", b"dash" * 4) + box(b"moov", b"m" * 300)
+    refs = b"".join(struct.pack(">III", segsize, d, 0) for d in durations)
+    sidx = box(b"sidx", struct.pack(">BxxxIIIIxxH", 0, 1, 1000, 0, 0,
+                                    len(durations)) + refs)
+    segments = b"".join(bytes(bytearray([n]) * segsize)
+                        for n in range(len(durations)))
+    return init + sidx + segments, len(init) - 1
+
+
+class TestClips(unittest.TestCase):
+
+    """ Tests for time range downloads using segment indexes. """
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.data, self.init_end = fragmented_mp4([10000] * 30, 1000)
+        self.stream, self.server = served_stream(
+            self, [(200, {}, self.data)], RangeHandler,
+            ("video", "m4v", "1920x1080", 0, "avc1"))
+        self.stream._parent._title = "clip"
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmpdir)
+
+    def test_sidx(self):
+        index = self.stream.get_segment_index()
+        self.assertEqual(len(index.segments), 30)
+        self.assertEqual(index.init[1], (0, self.init_end))
+        self.assertEqual(index.segments[12][:2], (120.0, 130.0))
+
+    def test_download_clip(self):
+        """ Only the init data and overlapping segments are fetched. """
+        filepath = self.stream.download_clip(120, 145, self.tmpdir,
+                                             quiet=True)
+        self.assertEqual(os.path.basename(filepath), "clip - 120-145.m4v")
+        with open(filepath, "rb") as f:
+            clip = f.read()
+        self.assertEqual(clip[:self.init_end + 1],
+                         self.data[:self.init_end + 1])
+        self.assertEqual(clip[self.init_end + 1:],
+                         b"".join(bytes(bytearray([n]) * 1000)
+                                  for n in (12, 13, 14)))
+        self.assertEqual(self.server.requests[-1]["Range"],
+                         "bytes=%d-%d" % (len(self.data) - 18000,
+                                          len(self.data) - 15001))
+
+    def test_manifest_ranges(self):
+        """ Ranges from a DASH manifest are fetched with one request. """
+        sidx_end = len(self.data) - 30000 - 1
+        self.stream._index_ranges = ((0, self.init_end),
+                                     (self.init_end + 1, sidx_end))
+        self.assertEqual(len(self.stream.get_segment_index().segments), 30)
+        self.assertEqual(self.server.requests[-1]["Range"],
+                         "bytes=0-%d" % sidx_end)
+
+    def test_no_index(self):
+        self.server.responses = [(200, {}, box(b"ftyp", b"") +
+                                  box(b"moov", b"") + box(b"mdat", b"x"))]
+        self.assertRaises(ValueError, self.stream.download_clip, 0, 10)
+
+    def test_fragments(self):
+        from pafy import dash
+        index = dash.fragment_index("http://x/", [("init", None),
+                                                  ("sq/1", 5.0),
+                                                  ("sq/2", 5.0),
+                                                  ("sq/3", 5.0)])
+        self.assertEqual(index.parts(6, 9), [("http://x/init", None),
+                                             ("http://x/sq/2", None)])
+
+
+FAKE_MUXER = """#!%s
+import sys
+args = sys.argv[1:]
+inputs = [args[n + 1] for n, a in enumerate(args) if a == "-i"]
+if "fail" in args[-1]:
+    sys.exit(1)
+with open(args[-1], "wb") as out:
+    for path in inputs:
+        if path == "pipe:0":
+            stdin = getattr(sys.stdin, "buffer", sys.stdin)
+            out.write(b"piped:" + stdin.read())
+            continue
+        with open(path, "rb") as f:
+            out.write(f.read())
+"""
+
+
+class TestMuxing(unittest.TestCase):
+
+    """ Tests for downloads piped into a muxer. """
+
+    def setUp(self):
+        import tempfile
+        self.tmpdir = tempfile.mkdtemp()
+        self.muxer = os.path.join(self.tmpdir, "fakemux")
+        with open(self.muxer, "w") as f:
+            f.write(FAKE_MUXER % sys.executable)
+        os.chmod(self.muxer, 0o755)
+        self.servers = [LocalServer([(200, {}, b"v" * 100000)]),
+                        LocalServer([(200, {}, b"a" * 30000)])]
+        self.video = FakePafy([("video", "m4v", "1920x1080", 0, "avc1"),
+                               ("audio", "m4a", "0x0", 131072, "mp4a")])
+        self.video._title = "merged"
+        for stream, server in zip(self.video.allstreams, self.servers):
+            stream._url = server.url()
+
+    def tearDown(self):
+        import shutil
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_muxers(self):
+        self.assertEqual(backend_shared.muxers("avconv"), ["avconv", "ffmpeg"])
+        self.assertEqual(backend_shared.muxers(True), ["ffmpeg", "avconv"])
+
+    def test_merged(self):
+        """ Both streams are fetched and muxed into one output file. """
+        progress = []
+        filepath = self.video.download_merged(
+            self.tmpdir, quiet=True, muxer=self.muxer,
+            callback=lambda total, *a: progress.append((total, a[1])))
+        self.assertEqual(filepath, os.path.join(self.tmpdir, "merged.mp4"))
+        with open(filepath, "rb") as f:
+            self.assertEqual(f.read(), b"v" * 100000 + b"a" * 30000)
+        self.assertEqual(progress[-1], (130000, 1.0))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["fakemux", "merged.mp4"])
+
+    def test_mux_failure(self):
+        """ A failing muxer raises IOError and leaves no files behind. """
+        filepath = os.path.join(self.tmpdir, "fail.mkv")
+        self.assertRaises(IOError, self.video.download_merged, filepath,
+                          quiet=True, muxer=self.muxer)
+        self.assertEqual(os.listdir(self.tmpdir), ["fakemux"])
+
+    def test_open_failure(self):
+        """ Responses opened are closed if another stream fails to open. """
+        self.video.audiostreams[0]._url = self.servers[1].url("/gone")
+        self.servers[1].responses = [(404, {}, b"")]
+        opened = []
+        open_url = backend_shared.open_url
+
+        def recording_open_url(url, *args):
+            opened.append(open_url(url, *args))
+            return opened[-1]
+
+        backend_shared.open_url = recording_open_url
+        self.addCleanup(setattr, backend_shared, "open_url", open_url)
+        self.assertRaises(util.HTTPError, self.video.download_merged,
+                          self.tmpdir, quiet=True, muxer=self.muxer)
+        self.assertEqual(len(opened), 1)
+        self.assertTrue(opened[0].fp is None)
+
+    def test_streaming_remux(self):
+        """ Audio is remuxed from a pipe as it downloads. """
+        audio = self.video.getbestaudio()
+        filepath = audio.download(os.path.join(self.tmpdir, "a.m4a"),
+                                  quiet=True, remux_audio=self.muxer)
+        with open(filepath, "rb") as f:
+            self.assertEqual(f.read(), b"piped:" + b"a" * 30000)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["a.m4a", "fakemux"])
+
+    def test_streaming_remux_fallback(self):
+        """ If no muxer works the download is kept unremuxed. """
+        audio = self.video.getbestaudio()
+        filepath = audio.download(os.path.join(self.tmpdir, "fail.m4a"),
+                                  quiet=True, remux_audio=self.muxer)
+        with open(filepath, "rb") as f:
+            self.assertEqual(f.read(), b"a" * 30000)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ["fail.m4a", "fakemux"])
+
+
+class ThumbHandler(LocalHandler):
+
+    """ Answer HEAD requests, hqdefault.jpg and worse exist. """
+
+    def do_HEAD(self):
+        self.server.requests.append(self.path)
+        name = self.path.split("/")[-1]
+        available = name in pafy.thumbs.THUMBS[2:]
+        self.send_response(200 if available else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+class TestThumbs(unittest.TestCase):
+
+    """ Tests for best thumbnail resolution. """
+
+    def setUp(self):
+        self.server = LocalServer([], ThumbHandler)
+        self.addCleanup(self.server.stop)
+        urls = dict(g.urls)
+        g.urls['thumbdir'] = self.server.url("/%s/")
+        self.addCleanup(setattr, g, "urls", urls)
+        pafy.thumbs.bestthumb_cache.clear()
+
+    def test_getbestthumb(self):
+        video = FakePafy([])
+        best = self.server.url("/DsAn_n6O5Ns/hqdefault.jpg")
+        self.assertEqual(video.getbestthumb(), best)
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(video.getbestthumb(), best)
+        self.assertEqual(FakePafy([]).getbestthumb(), best)
+        self.assertEqual(len(self.server.requests), 5)
+
+    def test_batch(self):
+        videoids = ["%011d" % n for n in range(4)]
+        found = pafy.get_bestthumbs(videoids[:2])
+        self.assertEqual(len(self.server.requests), 10)
+        found = pafy.get_bestthumbs(videoids, workers=3)
+        self.assertEqual(len(self.server.requests), 20)
+        self.assertEqual(found[videoids[3]],
+                         self.server.url("/%s/hqdefault.jpg" % videoids[3]))
+
+    def test_fetch_thumbs(self):
+        import shutil
+        import tempfile
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.server.responses = [(200, {"ETag": '"v1"'}, b"jpeg")]
+        self.server.RequestHandlerClass = LocalHandler
+        urls = [self.server.url("/a.jpg"), self.server.url("/b.jpg")]
+        found = pafy.fetch_thumbs(urls + urls[:1], path=tmpdir)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(found[urls[0]], found[urls[1]])
+        with open(found[urls[0]], "rb") as f:
+            self.assertEqual(f.read(), b"jpeg")
+        self.server.responses = [(304, {}, b"")]
+        events = []
+        pafy.add_hook(events.append)
+        self.addCleanup(pafy.remove_hook, events.append)
+        found = pafy.fetch_thumbs(urls, path=tmpdir, data=True)
+        self.assertEqual(found, {urls[0]: b"jpeg", urls[1]: b"jpeg"})
+        self.assertEqual([(e.phase, e.status, e.cache_hit) for e in events],
+                         [("thumb", 304, True)] * 2)
+        self.assertEqual(self.server.requests[-1]["If-None-Match"], '"v1"')
+
+    def test_cache_bounded(self):
+        cache = pafy.thumbs.BoundedCache(2)
+        for n in range(3):
+            cache.set(n, n)
+        self.assertEqual(cache.get(0), None)
+        cache.get(1)
+        cache.set(3, 3)
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), 1)
+
+    def test_cache_size_setting(self):
+        """ The best thumbnail cache follows g.thumb_cache_size. """
+        self.addCleanup(setattr, g, "thumb_cache_size", g.thumb_cache_size)
+        g.thumb_cache_size = 2
+        cache = pafy.thumbs.bestthumb_cache
+        for n in range(3):
+            cache.set(n, n)
+        self.assertEqual(len(cache), 2)
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    """ Tests for instrumentation events. """
+
+    def setUp(self):
+        self.events = []
+        pafy.add_hook(self.events.append)
+        self.addCleanup(pafy.remove_hook, self.events.append)
+
+    def test_fetch_events(self):
+        server = LocalServer([(200, {"Content-Type": "text/html"}, b"page"),
+                              (404, {}, b"")])
+        self.addCleanup(server.stop)
+        pafy.pafy.fetch_decode(server.url(), phase="embed")
+        self.assertRaises(util.HTTPError, pafy.pafy.fetch_decode,
+                          server.url(), phase="watchpage")
+        embed, watch = self.events
+        self.assertEqual((embed.phase, embed.bytes, embed.status),
+                         ("embed", 4, 200))
+        self.assertEqual(embed.host, "127.0.0.1:%d" % server.server_port)
+        self.assertEqual((watch.phase, watch.status), ("watchpage", 404))
+        self.assertTrue(watch.error is not None)
+
+    def test_download_event(self):
+        stream, _ = served_stream(self, [(200, {}, b"x" * 40000)])
+        self.assertEqual(len(b"".join(stream.iter_chunks())), 40000)
+        event, = self.events
+        self.assertEqual((event.phase, event.bytes, event.status),
+                         ("download", 40000, 200))
+
+    def test_range_event(self):
+        server = LocalServer([(200, {}, b"x" * 1000)], RangeHandler)
+        self.addCleanup(server.stop)
+        self.assertEqual(pafy.dash.fetch_range(server.url(), 10, 109),
+                         b"x" * 100)
+        event, = self.events
+        self.assertEqual((event.phase, event.bytes, event.status),
+                         ("index", 100, 206))
+
+    def test_timings(self):
+        """ Phases of a fetch are collected into the video's timings. """
+        from pafy.instrument import timed
+        server = LocalServer([(200, {"Content-Type": "text/html"}, b"page")])
+        self.addCleanup(server.stop)
+
+        class TimedPafy(FakePafy):
+            @backend_shared.timed_fetch
+            def _fetch_basic(self):
+                pafy.pafy.fetch_decode(server.url(), phase="vidinfo")
+                with timed("decipher"):
+                    time.sleep(0.01)
+                self._have_basic = True
+
+        video = TimedPafy([])
+        video._fetch_basic()
+        self.assertEqual(list(video.timings), ["vidinfo", "decipher", "total"])
+        self.assertTrue(video.timings["decipher"] >= 0.01)
+        self.assertTrue(video.timings["total"] >= video.timings["decipher"])
+        stats = pafy.PhaseStats()
+        stats.add_timings(video.timings)
+        stats.add_timings(video.timings)
+        self.assertEqual(stats.stats()["decipher"]["count"], 2)
+
+    def test_phase_stats(self):
+        stats = pafy.PhaseStats()
+        for duration in (0.001, 0.02, 0.2, 60):
+            event = pafy.instrument.Event("vidinfo", "http://x/")
+            event.duration, event.bytes = duration, 10
+            stats(event)
+        vidinfo = stats.stats()["vidinfo"]
+        self.assertEqual((vidinfo["count"], vidinfo["bytes"]), (4, 40))
+        self.assertEqual(vidinfo["histogram"][0], 1)
+        self.assertEqual(vidinfo["histogram"][-1], 1)
+        self.assertEqual(stats.percentile("vidinfo", 50), 0.025)
+        self.assertEqual(stats.percentile("vidinfo", 100), None)
+        self.assertTrue(stats.report().splitlines()[1].startswith("vidinfo"))
+
+
+class SiteHandler(LocalHandler):
+
+    """ Serve canned youtube pages by path, after server.delay seconds,
+    recording the paths and when each request started and finished. """
+
+    def do_GET(self):
+        path = self.path.split("?")[0].strip("/")
+        self.server.requests.append(path)
+        start = time.time()
+        time.sleep(self.server.delay)
+        body = self.server.pages[path]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.times[path] = start, time.time()
+
+
+class TestInternFetch(unittest.TestCase):
+
+    """ Offline tests of resolving videos with the internal backend. """
+
+    def setUp(self):
+        from pafy import backend_internal
+        from pafy.util import urlencode
+        self.backend = backend_internal
+        self.server = LocalServer([], SiteHandler)
+        self.server.delay, self.server.times = 0, {}
+        self.addCleanup(self.server.stop)
+        smap = urlencode({"itag": "18", "url": "http://x/18", "sig": "a"})
+        self.server.pages = {
+            "embed": b'"sts":17000',
+            "vidinfo": urlencode({
+                "status": "ok", "title": "t", "length_seconds": "10",
+                "fmt_list": "18/640x360", "use_cipher_signature": "False",
+                "url_encoded_fmt_stream_map": smap}).encode("utf8"),
+            "watch": b"<html>watch page</html>",
+        }
+        urls = dict(g.urls)
+        self.addCleanup(setattr, g, "urls", urls)
+        g.urls["embed"] = self.server.url("/embed")
+        g.urls["watchv"] = self.server.url("/watch?v=%s")
+        g.urls["vidinfo"] = self.server.url("/vidinfo?v=%s&e=%s&sts=%s")
+
+    def test_unciphered_video(self):
+        """ The watch page of unciphered videos is read for the age gate. """
+        video = self.backend.InternPafy("DsAn_n6O5Ns")
+        self.assertEqual(video.title, "t")
+        self.assertEqual(video.streams[0].itag, "18")
+        self.assertFalse(video.age_ver)
+        self.assertEqual(sorted(self.server.requests),
+                         ["embed", "vidinfo", "watch"])
+        self.assertEqual(list(video.timings), ["embed", "vidinfo",
+                                               "watchpage", "streams",
+                                               "total"])
+
+    def test_concurrent_requests(self):
+        """ The watch page is fetched alongside the video info. """
+        self.server.delay = 0.2
+        video = self.backend.InternPafy("DsAn_n6O5Ns")
+        self.assertEqual(video.streams[0].itag, "18")
+        times = self.server.times
+        # the watch page request overlaps the embed page request
+        self.assertTrue(times["watch"][0] < times["embed"][1])
+        self.assertTrue(times["watch"][1] > times["embed"][0])
+        timings = video.timings
+        self.assertTrue(timings["total"] < timings["embed"] +
+                        timings["vidinfo"] + timings["watchpage"])
+
+    def test_unciphered_age_gate(self):
+        self.server.pages["watch"] = (b'<div id="player-age-gate-content">' +
+                                      b"x" * 300000)
+        video = self.backend.InternPafy("DsAn_n6O5Ns")
+        self.assertTrue(video.age_ver)
+
+    def test_partial_watch_page(self):
+        """ The watch page is read only up to the player config. """
+        stats = self.backend.watchpage_stats.stats()
+        config = b'<html>;ytplayer.config = {"args": {}};'
+        self.server.pages["watch"] = config + b"x" * 300000
+        page = self.backend.fetch_watchpage(g.urls["watchv"] % "x")
+        self.assertTrue(page.startswith(config.decode("utf8")))
+        self.assertTrue(len(page) < 300000)
+        after = self.backend.watchpage_stats.stats()
+        self.assertEqual(after["partial"], stats["partial"] + 1)
+        self.assertTrue(after["bytes_saved"] - stats["bytes_saved"] > 200000)
+
+    def test_watch_page_end_across_chunks(self):
+        config = b'<html>;ytplayer.config = {"args": {"a": "b"}};'
+        self.server.pages["watch"] = b"x" * 100 + config + b"x" * 1000
+        response = util.open_url(g.urls["watchv"] % "x")
+        data = util.read_response(response, chunksize=7,
+                                  until=self.backend._WatchPageEnd())
+        self.assertIn(config, data)
+        self.assertTrue(len(data) < 100 + len(config) + 7)
+
+    def test_watch_page_without_config(self):
+        stats = self.backend.watchpage_stats.stats()
+        page = self.backend.fetch_watchpage(g.urls["watchv"] % "x")
+        self.assertEqual(page, "<html>watch page</html>")
+        after = self.backend.watchpage_stats.stats()
+        self.assertEqual(after["complete"], stats["complete"] + 1)
+        self.assertEqual(after["bytes_saved"], stats["bytes_saved"])
+
+
 PLAYLISTS = [
     {
         'identifier': "https://www.youtube.com/playlist?list=PL9-cZf_sidpkzR4W_LxvZjh4F7YFo4WoG",